@@ -0,0 +1,193 @@
+# autocomplete.py
+import re
+import time
+import logging
+import asyncpg
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# spelling variants that should complete to the same term
+_CHAR_MAP = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی",
+    "ك": "ک",
+    "ة": "ه", "ۀ": "ه",
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ؤ": "و",
+    "_": " ",
+    "\u200c": "",  # ZWNJ: «می‌شود» = «میشود»
+    "\u0640": "",  # tatweel
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # Persian digits
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic digits
+})
+_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670]")
+_SPACES_RE = re.compile(r"\s+")
+WORD_RE = re.compile(r"[\w\u200c]+")
+
+MIN_LENGTH = 2
+STOP_WORDS = {
+    "و", "در", "از", "به", "با", "برای", "که", "این", "ان", "را", "تا", "یا", "بر",
+    "هم", "ها", "های", "است", "شد", "می", "بی", "نیز", "یک",
+}
+
+
+def normalize(text: str) -> str:
+    """Lookup key of ``text``: lower case, unified letters/digits, no diacritics or leading #."""
+    text = _DIACRITICS_RE.sub("", text.lower().translate(_CHAR_MAP))
+    return _SPACES_RE.sub(" ", text).strip().lstrip("#").strip()
+
+
+def title_words(title: str) -> List[str]:
+    """Words of a post title worth completing to, as they are spelled in the title."""
+    words = []
+    for w in WORD_RE.findall(title or ""):
+        w = w.strip("\u200c_")
+        key = normalize(w)
+        if len(key) >= MIN_LENGTH and not key.isdigit() and key not in STOP_WORDS:
+            words.append(w)
+    return words
+
+
+class _Node:
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        # ids of the ``k`` heaviest terms below this node, heaviest first
+        self.top: List[int] = []
+
+
+class TermIndex:
+    """
+    In-memory prefix trie over normalised hashtags and post-title words.
+
+    Every node keeps the ids of the ``k`` heaviest terms below it, so
+    ``complete`` is a walk down the prefix and never visits a subtree.
+    Weights are numbers of posts: ``add`` moves a term up the lists of the
+    nodes on its path, ``remove`` moves it down and drops it at zero (a
+    lighter term that is not listed only takes its place on the next
+    ``load``). Term ids index
+    ``terms`` and are only valid until the next ``load``; ``epoch`` changes
+    with every load, so ids handed out earlier can be told apart.
+    """
+
+    def __init__(self, k: int = 8):
+        self.k = k
+        self.epoch = "%x" % int(time.time())
+        self._root = _Node()
+        self.terms: List[str] = []
+        self._weights: List[float] = []
+        self._ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    @staticmethod
+    def _ident(term: str) -> Tuple[str, str]:
+        key = normalize(term)
+        # a hashtag and a word with the same letters are different suggestions
+        return key, "#" + key if term.startswith("#") else key
+
+    def add(self, term: str, weight: float = 1) -> Optional[int]:
+        """Add ``weight`` to ``term`` (a #hashtag or a word); returns its id."""
+        key, ident = self._ident(term)
+        if len(key) < MIN_LENGTH:
+            return None
+        tid = self._ids.get(ident)
+        if tid is None:
+            tid = self._ids[ident] = len(self.terms)
+            self.terms.append(term)
+            self._weights.append(0)
+        self._weights[tid] += weight
+        node = self._root
+        self._promote(node, tid)
+        for ch in key:
+            node = node.children.setdefault(ch, _Node())
+            self._promote(node, tid)
+        return tid
+
+    def remove(self, term: str, weight: float = 1) -> None:
+        """Take ``weight`` off ``term``; at zero it is no longer suggested."""
+        key, ident = self._ident(term)
+        tid = self._ids.get(ident)
+        if tid is None:
+            return
+        self._weights[tid] -= weight
+        path = [self._root]
+        for ch in key:
+            path.append(path[-1].children[ch])
+        for node in path:
+            if tid not in node.top:
+                continue
+            if self._weights[tid] > 0:
+                self._promote(node, tid)
+            else:
+                node.top.remove(tid)
+
+    def _promote(self, node: _Node, tid: int) -> None:
+        top = node.top
+        if tid in top:
+            top.remove(tid)
+        weight = self._weights[tid]
+        i = 0
+        while i < len(top) and self._weights[top[i]] >= weight:
+            i += 1
+        if i < self.k:
+            top.insert(i, tid)
+            del top[self.k:]
+
+    def add_post(self, title: str, tags: Iterable[str]) -> None:
+        for t in tags:
+            self.add(t)
+        for w in title_words(title):
+            self.add(w)
+
+    def update_post(self, old_title: Optional[str], old_tags: Iterable[str],
+                    title: str, tags: Iterable[str]) -> None:
+        """Apply an edited post: only the words and tags that changed are re-weighted."""
+        old = Counter(title_words(old_title)) + Counter(old_tags)
+        new = Counter(title_words(title)) + Counter(tags)
+        for term, n in (new - old).items():
+            self.add(term, n)
+        for term, n in (old - new).items():
+            self.remove(term, n)
+
+    def complete(self, prefix: str, limit: Optional[int] = None) -> List[int]:
+        """Ids of the heaviest terms starting with ``prefix`` (after normalisation)."""
+        node = self._root
+        for ch in normalize(prefix):
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        return node.top[:limit or self.k]
+
+    async def load(self, pool: asyncpg.pool.Pool) -> int:
+        """Rebuild from hashtag_stats and the words of all post titles."""
+        async with pool.acquire() as conn:
+            tags = await conn.fetch(
+                """
+                SELECT h.name, s.posts FROM hashtag_stats s
+                JOIN hashtags h ON h.id = s.hashtag_id
+                WHERE s.posts > 0
+                ORDER BY s.posts DESC
+                """
+            )
+            words = await conn.fetch(
+                """
+                SELECT w, COUNT(*) AS n
+                FROM posts, regexp_split_to_table(title, '\\s+') AS w
+                WHERE w <> ''
+                GROUP BY w
+                ORDER BY n DESC
+                """
+            )
+        fresh = TermIndex(self.k)
+        for r in tags:
+            fresh.add(r["name"], r["posts"])
+        # most frequent spelling first, so it is the one shown for its key
+        for r in words:
+            for w in title_words(r["w"]):
+                fresh.add(w, r["n"])
+        self._root, self.terms, self._weights, self._ids = fresh._root, fresh.terms, fresh._weights, fresh._ids
+        self.epoch = fresh.epoch
+        logging.info("autocomplete index loaded: %s terms", len(self.terms))
+        return len(self.terms)
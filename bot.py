@@ -1,29 +1,106 @@
 import os
 import re
+import html
 import json
+import time
+import random
+import string
 import asyncio
 import asyncpg
 import logging
-from aiogram import Bot, Dispatcher, types
+from aiogram import types
 from aiogram.utils import executor
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from fsm_storage_postgres import PostgresStorage
+from migrations import migrate
+from channel_posts import parse_channel_post
+from broadcast import Broadcaster, RateLimiter
+from digest import DELIVERY_MODES, INSTANT, HOURLY, DAILY, run_digest_scheduler
+from service_catalog import ServiceCatalog
+from profiler import SamplingProfiler, ProfilingMiddleware
+from throttling import ThrottlingMiddleware, rate_limit, parse_limit, DEFAULT_KEY
+from db_router import DBRouter
+from bot_transport import TunedBot
+from scheduler import OrderedDispatcher
+from ttl_cache import TTLCache
+from autocomplete import TermIndex
+from recipients import DeadRecipients, run_dead_pruning, BLOCKED, OTHER
+from post_archive import ensure_partitions, run_partition_maintenance, RECENT_SINCE, POST_LOCK_NS
+from catchup import BotState, ChannelCatchUp, checkpoint_updates, LAST_CHANNEL_MESSAGE_ID, LAST_UPDATE_ID
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 
 # ----------------- تنظیمات از ENV -----------------
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "").strip()  # اختیاری: replica فقط‌خواندنی
 CHANNEL_ID = os.getenv("CHANNEL_ID", "").strip()
 CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "").strip()  # اختیاری
+BOT_API_SERVER = os.getenv("BOT_API_SERVER", "").strip()      # اختیاری: Bot API محلی یا سرور تست
 ADMINS = [7918162941]
+FSM_TTL_SECONDS = int(os.getenv("FSM_TTL_SECONDS", "86400"))        # 0 = بدون انقضا
+FSM_VACUUM_INTERVAL = int(os.getenv("FSM_VACUUM_INTERVAL", "600"))   # ثانیه
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))           # پیام در ثانیه
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+CATALOG_POLL_INTERVAL = int(os.getenv("CATALOG_POLL_INTERVAL", "60"))  # ثانیه
+DIGEST_DAILY_HOUR = int(os.getenv("DIGEST_DAILY_HOUR", "20"))       # ساعت ارسال خلاصهٔ روزانه
+SEARCH_RECENT_MONTHS = int(os.getenv("SEARCH_RECENT_MONTHS", "3"))   # جستجوی پیش‌فرض فقط در این چند ماه اخیر
+POST_RETENTION_MONTHS = int(os.getenv("POST_RETENTION_MONTHS", "24"))  # 0 = نگه‌داری همیشگی پست‌ها
+# اتصال HTTP به Bot API
+# پردازش آپدیت‌ها: چت‌های مختلف هم‌زمان، آپدیت‌های یک چت به ترتیب
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))      # آپدیت هم‌زمان در کل
+UPDATE_CHAT_QUEUE = int(os.getenv("UPDATE_CHAT_QUEUE", "32"))        # حداکثر آپدیت در صف هر چت
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))   # بیش از این، polling صبر می‌کنه
+# پست‌های کانال که وقت خاموشی ربات اومدن: ایندکس میشن و اگر از این چند ساعت جوان‌تر باشن ارسال میشن
+CATCHUP_MAX_AGE_HOURS = float(os.getenv("CATCHUP_MAX_AGE_HOURS", "24"))
+# ویرایش پست کانال با هشتگ جدید: به مشترکین اون هشتگ فرستاده میشه اگر پست از این چند ساعت جوان‌تر باشه؛ 0 = هرگز
+EDIT_NOTIFY_MAX_AGE_HOURS = float(os.getenv("EDIT_NOTIFY_MAX_AGE_HOURS", "24"))
+DEAD_PRUNE_DAYS = int(os.getenv("DEAD_PRUNE_DAYS", "30"))  # حذف اشتراک کاربرانی که ربات رو بلاک کردن؛ 0 = هرگز
+BOT_API_CONNECTIONS = int(os.getenv("BOT_API_CONNECTIONS", "100"))      # حداکثر اتصال هم‌زمان
+BOT_API_KEEPALIVE = float(os.getenv("BOT_API_KEEPALIVE", "60"))         # ثانیه
+BOT_API_DNS_TTL = int(os.getenv("BOT_API_DNS_TTL", "300"))              # ثانیه
+BOT_API_TIMEOUT = float(os.getenv("BOT_API_TIMEOUT", "10"))             # ثانیه، برای هر درخواست
+BOT_API_UPLOAD_TIMEOUT = float(os.getenv("BOT_API_UPLOAD_TIMEOUT", "60"))  # ثانیه، درخواست‌های دارای فایل
+# محدودیت درخواست هر کاربر: "نرخ در ثانیه,ظرفیت"
+THROTTLE_DEFAULT = parse_limit(os.getenv("THROTTLE_DEFAULT", "1,5"), (1.0, 5.0))
+THROTTLE_SEARCH = parse_limit(os.getenv("THROTTLE_SEARCH", "0.3,3"), (0.3, 3.0))
+THROTTLE_INLINE = parse_limit(os.getenv("THROTTLE_INLINE", "2,10"), (2.0, 10.0))
+# جستجوی inline (@bot کلیدواژه)
+INLINE_CACHE_TTL = int(os.getenv("INLINE_CACHE_TTL", "60"))    # ثانیه، کش داخل ربات
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "60"))  # ثانیه، کش سمت تلگرام
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS", "100"))
+INLINE_POST_CACHE = int(os.getenv("INLINE_POST_CACHE", "2000"))  # حداکثر پست آماده در حافظه (هر کدوم تا ~۷KB)
+SEARCH_SUGGESTIONS = int(os.getenv("SEARCH_SUGGESTIONS", "6"))  # تعداد دکمه‌های پیشنهاد کلیدواژه
+RELATED_TAGS = int(os.getenv("RELATED_TAGS", "6"))                  # تعداد دکمه‌های هشتگ مرتبط
+RELATED_CACHE_TTL = int(os.getenv("RELATED_CACHE_TTL", "600"))      # ثانیه
 
 logging.basicConfig(level=logging.INFO)
 
 # ساخت ربات و دیسپچر
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())  # فعلاً موقت، تو on_startup ست میشه
+bot = TunedBot(
+    token=BOT_TOKEN,
+    connections_limit=BOT_API_CONNECTIONS,
+    keepalive_timeout=BOT_API_KEEPALIVE,
+    dns_cache_ttl=BOT_API_DNS_TTL,
+    api_timeout=BOT_API_TIMEOUT,
+    upload_timeout=BOT_API_UPLOAD_TIMEOUT,
+    server=TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else TELEGRAM_PRODUCTION
+)
+dp = OrderedDispatcher(
+    bot,
+    storage=MemoryStorage(),  # فعلاً موقت، تو on_startup ست میشه
+    max_concurrency=UPDATE_CONCURRENCY,
+    max_queue_per_chat=UPDATE_CHAT_QUEUE,
+    max_pending=UPDATE_MAX_PENDING,
+)
+throttling = ThrottlingMiddleware({DEFAULT_KEY: THROTTLE_DEFAULT, "search": THROTTLE_SEARCH, "inline": THROTTLE_INLINE})
+dp.middleware.setup(throttling)
+# پروفایلر نمونه‌برداری؛ فقط وقتی ادمین /profile بزنه فعال میشه
+profiler = SamplingProfiler()
+dp.middleware.setup(ProfilingMiddleware(profiler))
 
 # اتصال به دیتابیس asyncpg
 async def create_pool():
@@ -35,11 +112,51 @@ async def create_pool():
 
 # on_startup:
 async def on_startup(dispatcher):
+    global broadcaster, catalog, dead_recipients, bot_state, catchup
     await init_db()
-    pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=1, max_size=5)
-    pg_storage = PostgresStorage(pool)
-    await pg_storage.create_table()
+    # قبل از catch-up: آپدیت‌هایی که ingest به dispatcher میده باید state رو از همین storage بخونن
+    pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=1, max_size=5, init=profiler.attach)
+    pg_storage = PostgresStorage(pool, ttl=FSM_TTL_SECONDS)  # جدولش توسط migrations ساخته میشه
+    # پاکسازی دوره‌ای ردیف‌های منقضی/خالی fsm_storage
+    pg_storage.start_vacuum(FSM_VACUUM_INTERVAL)
     dispatcher.storage = pg_storage
+    dead_recipients = DeadRecipients(db_pool)
+    await dead_recipients.load()
+    if DEAD_PRUNE_DAYS > 0:
+        asyncio.create_task(run_dead_pruning(db_pool, DEAD_PRUNE_DAYS))
+    # پارتیشن‌های ماهانهٔ posts: ساخت ماه‌های بعدی و حذف ماه‌های خارج از بازهٔ نگه‌داری
+    await ensure_partitions(db_pool)
+    asyncio.create_task(run_partition_maintenance(db_pool, POST_RETENTION_MONTHS))
+    await load_known_users()
+    # کاتالوگ خدمات از دیتابیس (بار اول از SERVICES پر میشه)
+    catalog = ServiceCatalog(db_pool)
+    await catalog.seed(SERVICES)
+    await catalog.load()
+    catalog.start_polling(CATALOG_POLL_INTERVAL)
+    broadcaster = Broadcaster(
+        bot, db_pool, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, dead=dead_recipients
+    )
+    # ادامهٔ ارسال‌های همگانی که با خاموش شدن ربات نیمه‌کاره موندن
+    await broadcaster.resume_pending()
+    # به‌جای skip_updates: پست‌های کانال زمان خاموشی ایندکس میشن (قبل از شروع polling)
+    # و در پس‌زمینه با همون محدودیت نرخ ارسال همگانی برای مشترکین فرستاده میشن
+    bot_state = BotState(db_pool)
+    catchup = ChannelCatchUp(
+        bot, db_pool, dispatcher, CHANNEL_ID_INT, bot_state, broadcaster.limiter, dead_recipients,
+        concurrency=BROADCAST_CONCURRENCY, max_age=CATCHUP_MAX_AGE_HOURS * 3600,
+    )
+    await catchup.ingest()
+    # پیشنهاد کلیدواژه از هشتگ‌ها و کلمات عنوان پست‌ها (بعد از catch-up تا پست‌های جامانده هم باشن)
+    await search_terms.load(db_pool)
+    asyncio.create_task(catchup.deliver(
+        get_instant_subscribers,
+        lambda uid, message_id, tags: copy_post_to_user(uid, CHANNEL_ID_INT, message_id, tags),
+    ))
+    asyncio.create_task(checkpoint_updates(bot_state, dispatcher))
+    # ارسال خلاصه‌های ساعتی/روزانه برای کاربرانی که حالت digest رو انتخاب کردن
+    asyncio.create_task(run_digest_scheduler(
+        bot, db_pool, RateLimiter(BROADCAST_RATE), CHANNEL_USERNAME, DIGEST_DAILY_HOUR, dead_recipients
+    ))
     print("بوت شروع شد.")
 
 
@@ -48,48 +165,14 @@ async def on_startup(dispatcher):
     # (اگر می‌خوای pool رو برای استفاده جای دیگه ذخیره کنی، میتونی dp['db_pool']=pool)
     # logging.info("Postgres FSM storage ready")
 
-# ========= کلاس مدیریت FSM در PostgreSQL =========
-class PostgresStorage:
-    def __init__(self, pool):
-        self.pool = pool
-
-    async def set_state(self, chat_id, user_id, state):
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO fsm_states (chat_id, user_id, state)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (chat_id, user_id) DO UPDATE SET state = $3
-            """, chat_id, user_id, state)
-
-    async def get_state(self, chat_id, user_id):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("""
-                SELECT state FROM fsm_states
-                WHERE chat_id=$1 AND user_id=$2
-            """, chat_id, user_id)
-            return row['state'] if row else None
-
-    async def finish(self, chat_id, user_id):
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-                DELETE FROM fsm_states WHERE chat_id=$1 AND user_id=$2
-            """, chat_id, user_id)
-
-# ========= ساخت جدول FSM در PostgreSQL =========
-CREATE_FSM_TABLE = """
-CREATE TABLE IF NOT EXISTS fsm_states (
-    chat_id BIGINT,
-    user_id BIGINT,
-    state TEXT,
-    PRIMARY KEY (chat_id, user_id)
-);
-"""
-
 class ServiceOrder(StatesGroup):
     waiting_for_docs = State()
     waiting_for_confirmation = State()
     confirm = State()
     
+class Broadcast(StatesGroup):
+    waiting_for_message = State()
+
 class AddService(StatesGroup):
     waiting_for_category = State()
     waiting_for_title = State()
@@ -102,14 +185,10 @@ if not BOT_TOKEN or not DATABASE_URL or not CHANNEL_ID:
 
 CHANNEL_ID_INT = int(CHANNEL_ID)
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    pool = await asyncpg.create_pool(dsn=DATABASE_URL)
-    storage = PostgresStorage(pool)
-    dp = Dispatcher(bot, storage=storage)
-
 waiting_for_keyword: dict[int, bool] = {}
 waiting_for_limit: dict[int, bool] = {}
+# آخرین کلیدواژهٔ هر چت، برای دکمهٔ «جستجو در آرشیو»
+last_search_keyword: dict[int, str] = {}
 user_search_limit: dict[int, int] = {}
 
 #@dp.callback_query_handler()
@@ -119,38 +198,17 @@ user_search_limit: dict[int, int] = {}
 
 # ----------------- DB pool -----------------
 db_pool: asyncpg.pool.Pool | None = None
-
-CREATE_TABLES_SQL = """
-CREATE TABLE IF NOT EXISTS posts (
-    id SERIAL PRIMARY KEY,
-    message_id BIGINT UNIQUE,
-    title TEXT,
-    content TEXT,
-    created_at TIMESTAMP DEFAULT now()
-);
-CREATE TABLE IF NOT EXISTS hashtags (
-    id SERIAL PRIMARY KEY,
-    name TEXT UNIQUE
-);
-CREATE TABLE IF NOT EXISTS post_hashtags (
-    post_id INTEGER REFERENCES posts(id) ON DELETE CASCADE,
-    hashtag_id INTEGER REFERENCES hashtags(id) ON DELETE CASCADE,
-    PRIMARY KEY (post_id, hashtag_id)
-);
-CREATE TABLE IF NOT EXISTS subscriptions (
-    user_id BIGINT,
-    hashtag_id INTEGER REFERENCES hashtags(id) ON DELETE CASCADE,
-    PRIMARY KEY (user_id, hashtag_id)
-);
--- توی PostgreSQL اجرا کن
-CREATE TABLE IF NOT EXISTS users (
-    user_id BIGINT PRIMARY KEY,
-    username TEXT,
-    first_name TEXT,
-    created_at TIMESTAMP DEFAULT now()
-);
-"""
-
+# db.read() → replica (اگر تنظیم شده و در دسترس باشه)، db.write() → primary
+db: DBRouter | None = None
+broadcaster: Broadcaster | None = None
+catalog: ServiceCatalog | None = None
+# کاربرانی که دیگه پیام دریافت نمی‌کنن (بلاک/حذف حساب)؛ دسته‌ای در users علامت می‌خورن
+dead_recipients: DeadRecipients | None = None
+# آخرین آپدیت و آخرین پست کانالِ ارسال‌شده (جدول bot_state)
+bot_state: BotState | None = None
+catchup: ChannelCatchUp | None = None
+
+# فقط برای پر کردن اولیهٔ جدول‌های service_categories/services استفاده میشه
 SERVICES = {
     "خدمات خودرو": [
         "ثبت نام ایران خودرو", "ثبت نام سایپا", "ثبت نام بهمن موتور", "دیگر ثبت نام ها",
@@ -205,49 +263,71 @@ def generate_order_id(length=6):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 
+# ----------------- کش کاربران ثبت‌نام‌شده -----------------
+# مجموعهٔ user_id های ثبت‌نام‌شده؛ موقع startup پر میشه و با هر ثبت‌نام آپدیت میشه
+known_users: set[int] = set()
+
+async def load_known_users():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id FROM users")
+    known_users.clear()
+    known_users.update(r["user_id"] for r in rows)
+    logging.info("known users loaded: %s", len(known_users))
+
+async def is_registered(user_id: int) -> bool:
+    if user_id in known_users:
+        return True
+    # ممکنه کاربر توسط یک worker دیگه ثبت شده باشه
+    row = await get_user_from_db(user_id)
+    if row:
+        known_users.add(user_id)
+    return row is not None
+
+
+# همیشه از primary، تا ثبت‌نامی که همین الان انجام شده دیده بشه
 async def get_user_from_db(user_id: int):
     async with db_pool.acquire() as conn:
         return await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", user_id)
 
-async def add_user_to_db(user_id: int, username: str = None, first_name: str = None):
+async def add_user_to_db(user_id: int, username: str = None, first_name: str = None) -> bool:
+    """ثبت کاربر؛ اگر کاربر جدید بود True برمی‌گردونه"""
+    if user_id in known_users:
+        return False
     async with db_pool.acquire() as conn:
-        await conn.execute(
+        inserted = await conn.fetchval(
             """
             INSERT INTO users (user_id, username, first_name)
             VALUES ($1, $2, $3)
             ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id
             """,
             user_id, username, first_name
         )
+    known_users.add(user_id)
+    return inserted is not None
 
 
 async def init_db():
-    global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10)
-    async with db_pool.acquire() as conn:
-        for stmt in CREATE_TABLES_SQL.strip().split(";"):
-            s = stmt.strip()
-            if s:
-                await conn.execute(s + ";")
-    print("✅ DB initialized")
+    global db_pool, db
+    db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=10, init=profiler.attach)
+    db = DBRouter(db_pool, DATABASE_READ_URL or None, pool_init=profiler.attach, min_size=1, max_size=10)
+    await db.connect()
+    # اعمال migration های جدید (اگر چیزی عوض نشده باشه فقط یک SELECT)
+    version = await migrate(db_pool)
+    print(f"✅ DB initialized (schema v{version})")
 
 user_search_limit: dict[int,int] = {}
 
 # گرفتن دسته‌بندی‌ها
-async def get_all_categories():
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT id, name FROM service_categories ORDER BY name")
+def get_all_categories():
+    return catalog.categories
 
 # افزودن خدمت جدید
 async def add_service_to_db(category_name, title, documents, price):
-    async with db_pool.acquire() as conn:
-        category = await conn.fetchrow("SELECT id FROM service_categories WHERE name=$1", category_name)
-        if not category:
-            raise ValueError("دسته‌بندی یافت نشد!")
-        await conn.execute(
-            "INSERT INTO services (category_id, title, documents, price) VALUES ($1, $2, $3, $4)",
-            category["id"], title, documents, price
-        )
+    category = catalog.category_by_name.get(category_name)
+    if not category:
+        raise ValueError("دسته‌بندی یافت نشد!")
+    return await catalog.add_service(category.id, title, documents, price)
 
 
 @dp.message_handler(lambda m: m.text.isdigit())
@@ -260,8 +340,7 @@ async def set_search_limit(msg: types.Message):
     await msg.answer(f"✅ تعداد پست در جستجو روی {n} تنظیم شد")
 
 async def ensure_user_exists(user: types.User):
-    u = await get_user_from_db(user.id)
-    if not u:
+    if user.id not in known_users:
         await add_user_to_db(user.id, user.username, user.first_name)
 
 
@@ -284,34 +363,41 @@ def get_user_search_limit(chat_id: int) -> int:
     return user_search_limit.get(chat_id, 5)
 
 
-async def search_posts_by_keyword(keyword: str, limit: int = 5):
+# پیش‌فرض فقط پارتیشن‌های SEARCH_RECENT_MONTHS ماه اخیر؛ archive=True فقط قدیمی‌ترها
+async def search_posts_by_keyword(keyword: str, limit: int = 5, archive: bool = False):
     kw = f"%{keyword}%"
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT message_id, title 
+    since = RECENT_SINCE.format("$3")
+    period = f"< {since}" if archive else f">= {since}"
+    async with db.read() as conn:
+        return await conn.fetch(f"""
+            SELECT message_id, title, content
             FROM posts
             WHERE title ILIKE $1
+              AND created_at {period}
             ORDER BY created_at DESC
             LIMIT $2
-        """, kw, limit)
+        """, kw, limit, SEARCH_RECENT_MONTHS)
 
 
 
-async def search_posts_by_tag(tag_name: str, limit: int = 5):
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT p.message_id,p.title FROM posts p
-            JOIN post_hashtags ph ON ph.post_id=p.id
+async def search_posts_by_tag(tag_name: str, limit: int = 5, archive: bool = False):
+    since = RECENT_SINCE.format("$3")
+    period = f"< {since}" if archive else f">= {since}"
+    async with db.read() as conn:
+        return await conn.fetch(f"""
+            SELECT p.message_id,p.title,p.content FROM posts p
+            JOIN post_hashtags ph ON ph.post_id=p.id AND ph.created_at=p.created_at
             JOIN hashtags h ON h.id=ph.hashtag_id
             WHERE h.name=$1
+              AND ph.created_at {period}
             ORDER BY p.created_at DESC
             LIMIT $2
-        """, tag_name, limit)
+        """, tag_name, limit, SEARCH_RECENT_MONTHS)
 
 
 # --- تابع گرفتن هشتگ‌های یک پست ---
 async def get_hashtags_for_post(post_db_id: int) -> list[str]:
-    async with db_pool.acquire() as conn:
+    async with db.read() as conn:
         rows = await conn.fetch("""
             SELECT h.name FROM hashtags h
             JOIN post_hashtags ph ON ph.hashtag_id = h.id
@@ -340,6 +426,15 @@ async def remove_subscription(user_id: int, tag_name: str):
             await conn.execute("DELETE FROM subscriptions WHERE user_id=$1 AND hashtag_id=$2", user_id, tag["id"])
 
 
+# همهٔ هشتگ‌ها به ترتیب تعداد مشترک (از جدول hashtag_stats، بدون COUNT)
+async def get_hashtags_by_popularity(conn):
+    return await conn.fetch("""
+        SELECT h.id, h.name FROM hashtags h
+        LEFT JOIN hashtag_stats s ON s.hashtag_id = h.id
+        ORDER BY COALESCE(s.subscribers, 0) DESC, h.name
+    """)
+
+
 # get_user_subscriptions
 async def get_user_subscriptions(user_id: int) -> list[str]:
     async with db_pool.acquire() as conn:
@@ -372,6 +467,25 @@ async def get_subscribers_for_hashtag(tag_name: str) -> list[int]:
         """, tag_name)
         return [r["user_id"] for r in rows]
 
+# سابسکرایبرهای هر کدوم از هشتگ‌ها که حالت دریافت فوری دارن (هر کاربر یک بار)؛
+# مشترکین هشتگ‌های except_tags کنار گذاشته میشن (قبلاً همین پست رو گرفتن)
+async def get_instant_subscribers(tags: list[str], except_tags: list[str] = ()) -> list[int]:
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT DISTINCT s.user_id FROM subscriptions s
+            JOIN hashtags h ON h.id=s.hashtag_id
+            LEFT JOIN users u ON u.user_id=s.user_id
+            WHERE h.name = ANY($1::text[])
+              AND COALESCE(u.delivery_mode, 'instant') = 'instant'
+              AND u.dead_at IS NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM subscriptions s2
+                  JOIN hashtags h2 ON h2.id = s2.hashtag_id
+                  WHERE s2.user_id = s.user_id AND h2.name = ANY($2::text[])
+              )
+        """, tags, list(except_tags))
+        return [r["user_id"] for r in rows]
+
 # ----------------- ارسال پست به کاربر -----------------
 def make_hashtag_buttons(tag_list: list[str]) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup(row_width=3)
@@ -379,83 +493,174 @@ def make_hashtag_buttons(tag_list: list[str]) -> InlineKeyboardMarkup:
         kb.add(InlineKeyboardButton(t, callback_data=f"tag_search:{t}"))
     return kb
 
-async def copy_post_to_user(user_id: int, from_chat_id: int, message_id: int, tags: list[str]):
-    try:
-        kb = make_hashtag_buttons(tags)
-        await bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id, reply_markup=kb)
-    except Exception:
-        text = f"📌 شناسه پیام: `{message_id}`"
-        await bot.send_message(user_id, text)
+async def copy_post_to_user(user_id: int, from_chat_id: int, message_id: int, tags: list[str]) -> bool:
+    kb = make_hashtag_buttons(tags)
+    for _ in range(2):
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id, reply_markup=kb)
+            return True
+        except RetryAfter as e:
+            await asyncio.sleep(e.timeout)
+        except TelegramAPIError as e:
+            # گیرندهٔ بلاک‌کرده/حذف‌شده علامت می‌خوره و دیگه براش ارسال نمیشه؛
+            # فقط وقتی خود پیام قابل کپی نبود شناسه‌اش رو می‌فرستیم
+            if dead_recipients.record(user_id, e) == OTHER:
+                try:
+                    await bot.send_message(user_id, f"📌 شناسه پیام: `{message_id}`")
+                except TelegramAPIError:
+                    pass
+            return False
+    return False
 
 # ----------------- هندلر پست کانال -----------------
 # هندلر برای پست‌های کانال
 @dp.channel_post_handler(content_types=types.ContentTypes.ANY)
 async def channel_post_handler(message: types.Message):
-    text = message.text or message.caption
-    if not text:
+    # عنوان (خط اول با 📌)، محتوا و هشتگ‌ها — همون parser که import_channel_export استفاده می‌کنه
+    parsed = parse_channel_post(message.text or message.caption)
+    if not parsed:
         return
-
-    # شرط 📌 → اگر نمی‌خوای، این بخش رو کامنت کن
-    first_line = text.splitlines()[0].strip()
-    if not first_line.startswith("📌"):
-        return
-
-    # عنوان و محتوا
-    title = re.sub(r"^📌\s*", "", first_line).strip()
-    content = "\n".join(text.splitlines()[1:]).strip()
-
-    # پیدا کردن هشتگ‌ها
-    tags = re.findall(r"#\S+", text)
+    title, content, tags = parsed
 
     # ذخیره در دیتابیس
     await save_post_and_tags(message.message_id, title, content, tags)
+    inline_cache.clear()
+    search_terms.add_post(title, tags)
+    for t in tags:
+        related_cache.invalidate(t)
+
+    # اول پست‌های جامانده از زمان خاموشی ارسال بشن، بعد این یکی
+    await catchup.done.wait()
+    # ارسال برای سابسکرایبرهای حالت «فوری» (بقیه در خلاصهٔ ساعتی/روزانه می‌گیرن)
+    for uid in await get_instant_subscribers(tags):
+        await copy_post_to_user(uid, CHANNEL_ID_INT, message.message_id, tags)
+    await dead_recipients.flush()
+    await bot_state.advance(LAST_CHANNEL_MESSAGE_ID, message.message_id)
+
+# ----------------- هندلر ویرایش پست کانال -----------------
+@dp.edited_channel_post_handler(content_types=types.ContentTypes.ANY)
+async def edited_channel_post_handler(message: types.Message):
+    parsed = parse_channel_post(message.text or message.caption)
+    if not parsed:
+        # 📌 از خط اول حذف شده: پست دیگه ایندکس نمیشه
+        deleted = await delete_post(message.message_id)
+        if deleted:
+            old_title, old_tags = deleted
+            inline_cache.clear()
+            inline_posts.invalidate(message.message_id)
+            # کلمه‌ها و هشتگ‌هایی که فقط در این پست بودن دیگه پیشنهاد نمیشن
+            search_terms.update_post(old_title, old_tags, "", [])
+            for t in old_tags:
+                related_cache.invalidate(t)
+        return
+    title, content, tags = parsed
+
+    # فقط هشتگ‌های اضافه/حذف‌شده در post_hashtags عوض میشن
+    old_title, old_tags = await save_post_and_tags(message.message_id, title, content, tags)
+    inline_cache.clear()
+    inline_posts.invalidate(message.message_id)
+    # فقط کلمه‌ها و هشتگ‌هایی که عوض شدن وزنشون تغییر می‌کنه
+    search_terms.update_post(old_title, old_tags, title, tags)
+    for t in set(tags) | set(old_tags):
+        related_cache.invalidate(t)
+
+    # مشترکین هشتگ‌های تازه که پست رو قبلاً (با هشتگ‌های قبلی) نگرفتن؛ فقط برای پست‌های تازه
+    added = sorted(set(tags) - set(old_tags))
+    age = time.time() - message.date.timestamp()
+    if not added or EDIT_NOTIFY_MAX_AGE_HOURS <= 0 or age > EDIT_NOTIFY_MAX_AGE_HOURS * 3600:
+        return
+    await catchup.done.wait()
+    for uid in await get_instant_subscribers(added, except_tags=old_tags):
+        await copy_post_to_user(uid, CHANNEL_ID_INT, message.message_id, tags)
+    await dead_recipients.flush()
 
-    # ارسال برای سابسکرایبرها
-    for tag in tags:
-        subs = await get_subscribers_for_hashtag(tag)
-        for uid in set(subs):
-            await copy_post_to_user(uid, CHANNEL_ID_INT, message.message_id, tags)
+async def delete_post(message_id: int) -> tuple[str | None, list[str]] | None:
+    """حذف پست از ایندکس؛ عنوان و هشتگ‌هاش رو برمی‌گردونه (None اگر ایندکس نشده بود)"""
+    async with db_pool.acquire() as conn:
+        # post_hashtags با ON DELETE CASCADE پاک میشه و triggerها hashtag_stats رو کم می‌کنن؛
+        # هشتگ‌ها از snapshot قبل از حذف خونده میشن
+        row = await conn.fetchrow(
+            """
+            WITH tags AS (
+                SELECT h.name FROM posts p
+                JOIN post_hashtags ph ON ph.post_id = p.id AND ph.created_at = p.created_at
+                JOIN hashtags h ON h.id = ph.hashtag_id
+                WHERE p.message_id = $1
+            ), deleted AS (
+                DELETE FROM posts WHERE message_id = $1 RETURNING title
+            )
+            SELECT title, ARRAY(SELECT name FROM tags) AS tags FROM deleted
+            """,
+            message_id
+        )
+    return (row["title"], list(row["tags"])) if row else None
 
-async def save_post_and_tags(message_id: int, title: str, content: str, tags: list[str]):
+async def save_post_and_tags(message_id: int, title: str, content: str, tags: list[str]) -> tuple[str | None, list[str]]:
+    """ذخیره/به‌روزرسانی پست؛ عنوان و هشتگ‌های قبلی پست رو برمی‌گردونه (برای پست جدید None و خالی)"""
     async with db_pool.acquire() as conn:
         async with conn.transaction():
-            # ذخیره پست
+            # message_id روی جدول پارتیشن‌شده UNIQUE نیست؛ ذخیرهٔ هم‌زمان یک پیام رو سریالی کن
+            await conn.execute("SELECT pg_advisory_xact_lock($1, $2)", POST_LOCK_NS, message_id)
+            # ذخیره پست (پست‌های قدیمی با حذف پارتیشن‌های ماهانه پاک میشن، نه اینجا)
             rec = await conn.fetchrow(
                 """
-                INSERT INTO posts(message_id, title, content)
-                VALUES($1, $2, $3)
-                ON CONFLICT(message_id) DO UPDATE 
-                SET title=EXCLUDED.title, content=EXCLUDED.content
-                RETURNING id
+                UPDATE posts p SET title=$2, content=$3
+                FROM posts prev
+                WHERE p.message_id=$1 AND prev.id=p.id AND prev.created_at=p.created_at
+                RETURNING p.id, p.created_at, prev.title AS old_title
                 """,
                 message_id, title, content
             )
-            post_db_id = rec["id"]
-
-            # حذف پست‌های قدیمی بیش از 1000
-            total = await conn.fetchval("SELECT COUNT(*) FROM posts")
-            if total > 1000:
-                to_remove = await conn.fetch(
-                    "SELECT id FROM posts ORDER BY created_at ASC LIMIT $1",
-                    total - 1000
+            if rec is None:
+                rec = await conn.fetchrow(
+                    """
+                    INSERT INTO posts(message_id, title, content)
+                    VALUES($1, $2, $3)
+                    RETURNING id, created_at, NULL AS old_title
+                    """,
+                    message_id, title, content
                 )
-                for r in to_remove:
-                    await conn.execute("DELETE FROM posts WHERE id=$1", r["id"])
 
-            # ذخیره هشتگ‌ها
-            for tag in tags:
-                hid = await get_or_create_hashtag(conn, tag)
+            # هشتگ‌ها: فقط تفاوت با هشتگ‌های فعلی پست اعمال میشه
+            old_tags = [r["name"] for r in await conn.fetch(
+                """
+                SELECT h.name FROM post_hashtags ph
+                JOIN hashtags h ON h.id = ph.hashtag_id
+                WHERE ph.post_id = $1 AND ph.created_at = $2
+                """,
+                rec["id"], rec["created_at"]
+            )]
+            added = list(set(tags) - set(old_tags))
+            removed = list(set(old_tags) - set(tags))
+            if removed:
+                await conn.execute(
+                    """
+                    DELETE FROM post_hashtags ph USING hashtags h
+                    WHERE ph.post_id = $1 AND ph.created_at = $2
+                      AND h.id = ph.hashtag_id AND h.name = ANY($3::text[])
+                    """,
+                    rec["id"], rec["created_at"], removed
+                )
+            if added:
                 await conn.execute(
                     """
-                    INSERT INTO post_hashtags(post_id, hashtag_id)
-                    VALUES($1, $2)
+                    INSERT INTO hashtags(name) SELECT unnest($1::text[])
+                    ON CONFLICT(name) DO NOTHING
+                    """,
+                    added
+                )
+                await conn.execute(
+                    """
+                    INSERT INTO post_hashtags(post_id, hashtag_id, created_at)
+                    SELECT $1, id, $2 FROM hashtags WHERE name = ANY($3::text[])
                     ON CONFLICT DO NOTHING
                     """,
-                    post_db_id, hid
+                    rec["id"], rec["created_at"], added
                 )
+    return rec["old_title"], old_tags
 
 async def get_post_db_row_by_message_id(message_id: int):
-    async with db_pool.acquire() as conn:
+    async with db.read() as conn:
         return await conn.fetchrow(
             "SELECT id,message_id,title,content FROM posts WHERE message_id=$1",
             message_id
@@ -489,34 +694,39 @@ def main_menu_keyboard(user_id=None):
 
 
 @dp.message_handler(commands=["start"])
-async def cmd_start(message: types.Message):
-    kb = main_menu_keyboard(message.from_user.id)
+async def cmd_start(msg: types.Message):
+    # کاربری که قبلاً ربات رو بلاک کرده بود برگشته (فقط برای کاربرهای علامت‌خورده به دیتابیس می‌نویسه)
+    await dead_recipients.revive(msg.from_user.id)
     await msg.answer(
         "سلام 👋\nمنو را انتخاب کنید:",
         reply_markup=main_menu_keyboard(msg.from_user.id)
     )
     
+# بلاک/آنبلاک شدن ربات توسط کاربر (آپدیت my_chat_member)
+@dp.my_chat_member_handler()
+async def on_my_chat_member(update: types.ChatMemberUpdated):
+    if update.chat.type != types.ChatType.PRIVATE:
+        return
+    status = update.new_chat_member.status
+    if status == types.ChatMemberStatus.KICKED:
+        dead_recipients.add(update.chat.id, BLOCKED)
+        await dead_recipients.flush()
+    elif status == types.ChatMemberStatus.MEMBER:
+        await dead_recipients.revive(update.chat.id)
+
 # ----------------- هندلر ثبت‌نام -----------------
 @dp.message_handler(lambda m: m.text and "ثبت" in m.text and "نام" in m.text)
 async def register_user(msg: types.Message):
-    async with db_pool.acquire() as conn:
-        # بررسی وجود کاربر
-        row = await conn.fetchrow("SELECT user_id FROM users WHERE user_id=$1", msg.from_user.id)
-        if row:
-            await msg.answer("✅ شما قبلاً ثبت‌نام شده‌اید.")
-            return
-
-        # ثبت کاربر جدید
-        await conn.execute(
-            """
-            INSERT INTO users(user_id, username, first_name, created_at)
-            VALUES($1, $2, $3, NOW())
-            """,
-            msg.from_user.id,
-            msg.from_user.username or "",
-            msg.from_user.first_name or ""
-        )
-        await msg.answer("🎉 ثبت‌نام شما با موفقیت انجام شد!")
+    # ثبت کاربر جدید (اگر قبلاً ثبت شده باشه هیچ نوشتنی انجام نمیشه)
+    inserted = await add_user_to_db(
+        msg.from_user.id,
+        msg.from_user.username or "",
+        msg.from_user.first_name or ""
+    )
+    if not inserted:
+        await msg.answer("✅ شما قبلاً ثبت‌نام شده‌اید.")
+        return
+    await msg.answer("🎉 ثبت‌نام شما با موفقیت انجام شد!")
 
 
 
@@ -534,24 +744,135 @@ async def set_search_limit(msg: types.Message):
 
 # --- جستجو ---
 @dp.message_handler(lambda m: m.text == "🔍 جستجو اطلاعیه/خبر")
+@rate_limit("search")
 async def start_search_flow(msg: types.Message):
     waiting_for_keyword[msg.chat.id] = True
-    await msg.answer("🔎 لطفاً کلیدواژهٔ جستجو را بفرست (جستجو فقط در عنوان‌ها انجام خواهد شد):")
+    await msg.answer(
+        "🔎 لطفاً کلیدواژهٔ جستجو را بفرست (جستجو فقط در عنوان‌ها انجام خواهد شد)"
+        " یا یکی از موضوعات پرتکرار را انتخاب کن:",
+        reply_markup=suggestions_keyboard("")
+    )
+
+# --- پیشنهاد کلیدواژه (trie هشتگ‌ها و کلمات عنوان‌ها، در حافظه) ---
+search_terms = TermIndex(k=SEARCH_SUGGESTIONS)
+
+def suggestions_keyboard(prefix: str, kb: InlineKeyboardMarkup | None = None,
+                         skip: str | None = None) -> InlineKeyboardMarkup | None:
+    """دکمهٔ پرتکرارترین هشتگ‌ها/کلماتی که با prefix شروع میشن (بدون توجه به ی/ي، ک/ك، نیم‌فاصله و ...)"""
+    buttons = []
+    for tid in search_terms.complete(prefix):
+        term = search_terms.terms[tid]
+        if term == skip:
+            continue
+        # هشتگ همون جستجوی هشتگ؛ کلمه خودش، یا اگر در 64 بایت callback_data جا نشد شناسه‌اش
+        # همراه epoch ایندکس (شناسه‌ها بعد از ری‌استارت به کلمه‌های دیگه می‌رسن)
+        if term.startswith("#"):
+            data = f"tag_search:{term}"
+        else:
+            data = f"suggest:{term}"
+            if len(data.encode()) > 64:
+                data = f"suggest_id:{search_terms.epoch}:{tid}"
+        if len(data.encode()) <= 64:
+            buttons.append(InlineKeyboardButton(term, callback_data=data))
+    if not buttons:
+        return kb
+    kb = kb or InlineKeyboardMarkup()
+    for i in range(0, len(buttons), 3):
+        kb.row(*buttons[i:i + 3])
+    return kb
 
 # ===============================
 # هندلر نمایش متن جستجو
 #================================
 @dp.message_handler(lambda m: m.chat.id in waiting_for_keyword)
+@rate_limit("search")
 async def handle_search_input(msg: types.Message):
     if not waiting_for_keyword.pop(msg.chat.id, None):
         return
+    await search_keyword(msg, msg.text.strip())
+
+# کلیدواژه‌ای که از دکمه‌های پیشنهاد انتخاب شد
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith(("suggest:", "suggest_id:")))
+@rate_limit("search")
+async def callback_suggest(call: types.CallbackQuery):
+    kind, _, value = call.data.partition(":")
+    keyword = None
+    if kind == "suggest":
+        # فقط‌عدد: دکمهٔ قدیمی با شناسه (کلمهٔ پیشنهادی هیچ‌وقت فقط عدد نیست)
+        keyword = None if value.isdigit() else value
+    else:
+        epoch, _, tid = value.partition(":")
+        if epoch == search_terms.epoch and tid.isdigit() and int(tid) < len(search_terms.terms):
+            keyword = search_terms.terms[int(tid)]
+    if not keyword:
+        # دکمهٔ قدیمی از قبل از ری‌استارت ربات
+        await call.answer("⌛️ لطفاً دوباره جستجو کنید.", show_alert=True)
+        return
+    waiting_for_keyword.pop(call.message.chat.id, None)
+    await call.answer()
+    await search_keyword(call.message, keyword)
 
+async def search_keyword(msg: types.Message, keyword: str):
     limit = user_search_limit.get(msg.chat.id, 5)
-    results = await search_posts_by_keyword(msg.text.strip(), limit=limit)
+    results = await search_posts_by_keyword(keyword, limit=limit)
+    if len(results) < limit:
+        last_search_keyword[msg.chat.id] = keyword
     if not results:
-        await msg.answer("❌ موردی پیدا نشد.")
+        # املای دیگه یا کلمهٔ کامل‌تر که واقعاً در عنوان‌ها/هشتگ‌ها هست
+        kb = suggestions_keyboard(keyword, archive_keyboard("archive_search"), skip=keyword)
+        await msg.answer(f"❌ در {SEARCH_RECENT_MONTHS} ماه اخیر موردی پیدا نشد.", reply_markup=kb)
         return
 
+    await send_search_results(msg, results)
+    if len(results) < limit:
+        kb = suggestions_keyboard(keyword, archive_keyboard("archive_search"), skip=keyword)
+        await msg.answer("نتایج قدیمی‌تر یا جستجوهای نزدیک:", reply_markup=kb)
+
+
+# --- جستجو در آرشیو (پست‌های قدیمی‌تر از SEARCH_RECENT_MONTHS ماه) ---
+def archive_keyboard(callback_data: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("🗄 جستجو در آرشیو", callback_data=callback_data))
+    return kb
+
+def archive_tag_keyboard(tag: str) -> InlineKeyboardMarkup | None:
+    # callback_data حداکثر 64 بایت؛ هشتگ خیلی بلند دکمهٔ آرشیو نمی‌گیره (وگرنه کل کیبورد رد میشه)
+    data = f"archive_tag:{tag}"
+    return archive_keyboard(data) if len(data.encode()) <= 64 else None
+
+@dp.callback_query_handler(lambda c: c.data == "archive_search")
+@rate_limit("search")
+async def callback_archive_search(call: types.CallbackQuery):
+    keyword = last_search_keyword.get(call.message.chat.id)
+    if not keyword:
+        await call.answer("⌛️ لطفاً دوباره جستجو کنید.", show_alert=True)
+        return
+    limit = user_search_limit.get(call.message.chat.id, 5)
+    results = await search_posts_by_keyword(keyword, limit=limit, archive=True)
+    if not results:
+        await call.answer("در آرشیو هم موردی پیدا نشد.", show_alert=True)
+        return
+    await call.answer()
+    await send_search_results(call.message, results)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("archive_tag:"))
+@rate_limit("search")
+async def callback_archive_tag(call: types.CallbackQuery):
+    tag = call.data.split("archive_tag:")[1]
+    results = await search_posts_by_tag(tag, get_user_search_limit(call.from_user.id), archive=True)
+    if not results:
+        await call.answer("در آرشیو هم پستی با این هشتگ نیست.", show_alert=True)
+        return
+    await call.answer(f"در حال ارسال {len(results)} پست قدیمی‌تر با {tag} ...")
+    for r in results:
+        row = await get_post_db_row_by_message_id(r["message_id"])
+        tags = await get_hashtags_for_post(row["id"]) if row else []
+        await copy_post_to_user(call.from_user.id, CHANNEL_ID_INT, r["message_id"], tags)
+    # گیرندهٔ بلاک‌کرده همین‌جا ثبت میشه؛ نه فقط در ارسال بعدی کانال که شاید دیر برسه
+    await dead_recipients.flush()
+
+
+async def send_search_results(msg: types.Message, results):
     for r in results:
         row = await get_post_db_row_by_message_id(r["message_id"])
         if not row:
@@ -580,20 +901,21 @@ async def handle_search_input(msg: types.Message):
 # ==============================
 @dp.message_handler(lambda m: m.text == "🔔 دریافت خودکار اطلاعیه/خبر")
 async def show_subscription_menu(msg: types.Message):
-    async with db_pool.acquire() as conn:
-        # بررسی ثبت‌نام کاربر
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE user_id=$1", msg.from_user.id)
-        if not user:
-            await msg.answer("⚠️ لطفاً ابتدا در ربات ثبت‌نام کنید. (📝 ثبت‌نام در ربات)")
-            return
+    # بررسی ثبت‌نام کاربر
+    if not await is_registered(msg.from_user.id):
+        await msg.answer("⚠️ لطفاً ابتدا در ربات ثبت‌نام کنید. (📝 ثبت‌نام در ربات)")
+        return
 
+    async with db.read() as conn:
         # دریافت همه هشتگ‌ها
-        all_tags = await conn.fetch("SELECT id, name FROM hashtags ORDER BY name")
+        all_tags = await get_hashtags_by_popularity(conn)
         if not all_tags:
             await msg.answer("هنوز هیچ هشتگی ثبت نشده است.")
             return
 
-        # دریافت هشتگ‌های فعال کاربر
+    # هشتگ‌های فعال کاربر از primary: همین الان ممکنه toggle_subscription نوشته باشه
+    # و replica هنوز عقب باشه
+    async with db_pool.acquire() as conn:
         user_tags_rows = await conn.fetch(
             "SELECT hashtag_id FROM subscriptions WHERE user_id=$1",
             msg.from_user.id
@@ -635,15 +957,22 @@ async def toggle_subscription(callback: types.CallbackQuery):
             await conn.execute("INSERT INTO subscriptions (user_id, hashtag_id) VALUES ($1, $2)", user_id, tag_id)
 
         # دریافت مجدد داده‌ها
-        all_tags = await conn.fetch("SELECT id, name FROM hashtags ORDER BY name")
+        all_tags = await get_hashtags_by_popularity(conn)
         user_tags_rows = await conn.fetch("SELECT hashtag_id FROM subscriptions WHERE user_id=$1", user_id)
         user_tags = {r["hashtag_id"] for r in user_tags_rows}
 
     # بازسازی کیبورد
     kb = InlineKeyboardMarkup(row_width=2)
-    for t in all_tags:
-        status = "✅" if t["id"] in user_tags else "❌"
-        kb.insert(InlineKeyboardButton(f"{status} {t['name']}", callback_data=f"toggle:{t['id']}"))
+    if not exists:
+        # پیشنهاد هشتگ‌هایی که معمولاً همراه این هشتگ میان و کاربر هنوز عضوشون نیست
+        related = [(rid, name) for rid, name in await get_related_hashtags(tag["name"]) if rid not in user_tags]
+        for i in range(0, len(related), 3):
+            kb.row(*(InlineKeyboardButton(f"➕ {name}", callback_data=f"toggle:{rid}") for rid, name in related[i:i + 3]))
+    # add (نه insert) تا دکمهٔ هشتگ‌ها به آخرین ردیف مرتبط‌ها نچسبه
+    kb.add(*(
+        InlineKeyboardButton(f"{'✅' if t['id'] in user_tags else '❌'} {t['name']}", callback_data=f"toggle:{t['id']}")
+        for t in all_tags
+    ))
 
     kb.add(InlineKeyboardButton("ثبت نهایی ✅", callback_data="register"))
 
@@ -668,12 +997,18 @@ async def get_user_subscriptions(user_id: int) -> list[str]:
 
 # --- هندلر جستجو با هشتگ ---
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("tag_search:"))
+@rate_limit("search")
 async def callback_tag_search(call: types.CallbackQuery):
     tag = call.data.split("tag_search:")[1]
     limit = 5  # یا از get_user_search_limit(call.from_user.id) استفاده کن
     results = await search_posts_by_tag(tag, limit)
+    related = await get_related_hashtags(tag)
     if not results:
-        await call.answer("هیچ پستی با این هشتگ پیدا نشد.", show_alert=True)
+        await call.answer()
+        await call.message.answer(
+            f"در {SEARCH_RECENT_MONTHS} ماه اخیر پستی با {tag} نیست.",
+            reply_markup=related_keyboard(related, archive_tag_keyboard(tag))
+        )
         return
 
     await call.answer(f"در حال ارسال {len(results)} پست اخیر با {tag} ...")
@@ -681,11 +1016,52 @@ async def callback_tag_search(call: types.CallbackQuery):
         row = await get_post_db_row_by_message_id(r["message_id"])
         tags = await get_hashtags_for_post(row["id"]) if row else []
         await copy_post_to_user(call.from_user.id, CHANNEL_ID_INT, r["message_id"], tags)
+    await dead_recipients.flush()
+    archive = archive_tag_keyboard(tag)
+    if len(results) < limit and archive:
+        await call.message.answer(
+            f"پست‌های قدیمی‌تر با {tag}:",
+            reply_markup=related_keyboard(related, archive)
+        )
+    elif related:
+        await call.message.answer(f"🏷 هشتگ‌های مرتبط با {tag}:", reply_markup=related_keyboard(related))
+
+# --- هشتگ‌های مرتبط (از جدول hashtag_pairs که triggerها به‌روز نگه می‌دارن) ---
+# با هر پست جدید/ویرایش‌شده، هشتگ‌های اون پست از کش حذف میشن
+related_cache = TTLCache(RELATED_CACHE_TTL, max_entries=5000)
+
+async def get_related_hashtags(tag_name: str) -> list[tuple[int, str]]:
+    """پرتکرارترین هشتگ‌هایی که با tag_name در یک پست اومدن: [(id, name)]"""
+    async def load():
+        async with db.read() as conn:
+            rows = await conn.fetch("""
+                SELECT r.id, r.name FROM hashtags h
+                JOIN hashtag_pairs hp ON hp.hashtag_id = h.id
+                JOIN hashtags r ON r.id = hp.related_id
+                WHERE h.name = $1 AND hp.posts > 0
+                ORDER BY hp.posts DESC
+                LIMIT $2
+            """, tag_name, RELATED_TAGS)
+        return [(r["id"], r["name"]) for r in rows]
+    return await related_cache.get_or_load(tag_name, load)
+
+def related_keyboard(related: list[tuple[int, str]], kb: InlineKeyboardMarkup | None = None) -> InlineKeyboardMarkup | None:
+    buttons = [
+        InlineKeyboardButton(name, callback_data=f"tag_search:{name}")
+        for _, name in related if len(f"tag_search:{name}".encode()) <= 64
+    ]
+    if not buttons:
+        return kb
+    kb = kb or InlineKeyboardMarkup()
+    for i in range(0, len(buttons), 3):
+        kb.row(*buttons[i:i + 3])
+    return kb
 
 # =======================================
 # هندلر نمایش متن کامل
 # =======================================
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("view:"))
+@rate_limit("search")
 async def callback_view_post(call: types.CallbackQuery):
     msg_id = int(call.data.split("view:")[1])
     row = await get_post_db_row_by_message_id(msg_id)
@@ -698,36 +1074,88 @@ async def callback_view_post(call: types.CallbackQuery):
     await call.answer()
 
 
-    limit = user_search_limit.get(msg.chat.id, 5)
-    results = await search_posts_by_keyword(msg.text.strip(), limit=limit)
-    if not results:
-        await msg.answer("❌ موردی پیدا نشد.")
-        return
+# =======================================
+# جستجوی inline: @bot کلیدواژه یا @bot #هشتگ
+# =======================================
+INLINE_PAGE_SIZE = 20
+# message_idهای نتیجه به ازای هر عبارت؛ با هر پست جدید کانال خالی میشه
+inline_cache = TTLCache(INLINE_CACHE_TTL, max_entries=2000)
+# نتیجهٔ آمادهٔ هر پست، مشترک بین همهٔ عبارت‌ها (هر پست زیر خیلی از پیشوندها تکرار میشه)
+inline_posts = TTLCache(INLINE_CACHE_TTL, max_entries=INLINE_POST_CACHE)
+
+def inline_article(r) -> types.InlineQueryResultArticle:
+    title, content = r["title"] or "", r["content"] or ""
+    link = f"https://t.me/{CHANNEL_USERNAME}/{r['message_id']}" if CHANNEL_USERNAME else None
+    body = f"📌 <b>{html.escape(title)}</b>\n\n{html.escape(content[:3500])}"
+    if link:
+        body += f"\n\n🔗 <a href='{link}'>مشاهده در کانال</a>"
+    return types.InlineQueryResultArticle(
+        id=str(r["message_id"]),
+        title=title or "📌",
+        description=content[:100],
+        url=link,
+        input_message_content=types.InputTextMessageContent(
+            body, parse_mode="HTML", disable_web_page_preview=True
+        ),
+    )
 
-    for r in results:
-        row = await get_post_db_row_by_message_id(r["message_id"])
-        tags = await get_hashtags_for_post(row["id"]) if row else []
-        await copy_post_to_user(msg.chat.id, CHANNEL_ID_INT, r["message_id"], tags)
+async def load_inline_results(text: str) -> tuple:
+    if text.startswith("#"):
+        rows = await search_posts_by_tag(text, INLINE_MAX_RESULTS)
+    else:
+        rows = await search_posts_by_keyword(text, INLINE_MAX_RESULTS)
+    # صفحهٔ اول معمولاً همین الان لازمه؛ بقیه اگر ورق زده شد از دیتابیس
+    for r in rows[:INLINE_PAGE_SIZE]:
+        inline_posts.set(r["message_id"], inline_article(r))
+    return tuple(r["message_id"] for r in rows)
+
+async def inline_articles(message_ids) -> list:
+    articles = {mid: inline_posts.get(mid) for mid in message_ids}
+    missing = [mid for mid, a in articles.items() if a is None]
+    if missing:
+        async with db.read() as conn:
+            rows = await conn.fetch(
+                "SELECT message_id, title, content FROM posts WHERE message_id = ANY($1::bigint[])",
+                missing,
+            )
+        for r in rows:
+            articles[r["message_id"]] = inline_article(r)
+            inline_posts.set(r["message_id"], articles[r["message_id"]])
+    # پست‌هایی که در این فاصله حذف شدن رد میشن
+    return [articles[mid] for mid in message_ids if articles[mid] is not None]
+
+@dp.inline_handler()
+@rate_limit("inline")
+async def inline_search(query: types.InlineQuery):
+    text = " ".join(query.query.split())
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    message_ids = await inline_cache.get_or_load(text, lambda: load_inline_results(text))
+    end = offset + INLINE_PAGE_SIZE
+    await query.answer(
+        await inline_articles(message_ids[offset:end]),
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(end) if end < len(message_ids) else "",
+    )
 
 
 # --- منوی اشتراک ---
 # نمایش منوی اشتراک
 @dp.message_handler(lambda m: m.text == "🔔 دریافت خودکار اطلاعیه/خبر")
 async def show_subscription_menu(msg: types.Message):
-    async with db_pool.acquire() as conn:
-        # بررسی ثبت‌نام کاربر
-        user = await conn.fetchrow("SELECT user_id FROM users WHERE user_id=$1", msg.from_user.id)
-        if not user:
-            await msg.answer("⚠️ لطفاً ابتدا در ربات ثبت‌نام کنید. (📝 ثبت‌نام در ربات)")
-            return
+    # بررسی ثبت‌نام کاربر
+    if not await is_registered(msg.from_user.id):
+        await msg.answer("⚠️ لطفاً ابتدا در ربات ثبت‌نام کنید. (📝 ثبت‌نام در ربات)")
+        return
 
+    async with db.read() as conn:
         # دریافت تمام هشتگ‌ها
-        all_tags = await conn.fetch("SELECT id, name FROM hashtags ORDER BY name")
+        all_tags = await get_hashtags_by_popularity(conn)
         if not all_tags:
             await msg.answer("هنوز هیچ هشتگی ثبت نشده است.")
             return
 
-        # دریافت هشتگ‌های سابسکرایب‌شده کاربر
+    # هشتگ‌های سابسکرایب‌شدهٔ کاربر از primary (replica ممکنه از آخرین toggle عقب باشه)
+    async with db_pool.acquire() as conn:
         user_tags_rows = await conn.fetch(
             """
             SELECT hashtag_id
@@ -772,7 +1200,7 @@ async def toggle_subscription(callback: types.CallbackQuery):
             )
 
         # دریافت مجدد وضعیت هشتگ‌ها
-        all_tags = await conn.fetch("SELECT id, name FROM hashtags ORDER BY name")
+        all_tags = await get_hashtags_by_popularity(conn)
         user_tags_rows = await conn.fetch(
             "SELECT hashtag_id FROM subscriptions WHERE user_id=$1", user_id
         )
@@ -795,6 +1223,7 @@ async def toggle_subscription(callback: types.CallbackQuery):
 
 
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith("tag_search:"))
+@rate_limit("search")
 async def callback_tag_search(call: types.CallbackQuery):
     tag = call.data.split("tag_search:")[1]
     limit = get_user_search_limit(call.from_user.id)
@@ -807,28 +1236,46 @@ async def callback_tag_search(call: types.CallbackQuery):
         row = await get_post_db_row_by_message_id(r["message_id"])
         tags = await get_hashtags_for_post(row["id"]) if row else []
         await copy_post_to_user(call.from_user.id, CHANNEL_ID_INT, r["message_id"], tags)
+    await dead_recipients.flush()
 
 # ========================
 # سفارش خدمات
 # ========================
 @dp.message_handler(lambda m: m.text == "🛠 سفارش خدمات")
 async def show_services_menu(msg: types.Message):
-    kb = InlineKeyboardMarkup(row_width=2)
-    for category in SERVICES.keys():
-        kb.add(InlineKeyboardButton(category, callback_data=f"service_cat:{category}"))
-    await msg.answer("📂 دسته‌بندی خدمات:", reply_markup=kb)
+    await msg.answer("📂 دسته‌بندی خدمات:", reply_markup=catalog.menu_keyboard())
+
+@dp.callback_query_handler(lambda c: c.data == "back_to_services")
+async def back_to_services(call: types.CallbackQuery):
+    await call.message.edit_text("📂 دسته‌بندی خدمات:", reply_markup=catalog.menu_keyboard())
+    await call.answer()
+
+def catalog_callback_id(call: types.CallbackQuery) -> int | None:
+    """شناسهٔ دسته/خدمت در callback_data؛ دکمه‌های قبل از کاتالوگ دیتابیسی هنوز اسم فارسی دارن"""
+    try:
+        return int(call.data.split(":", 1)[1])
+    except ValueError:
+        return None
+
+async def answer_expired_menu(call: types.CallbackQuery):
+    await call.answer("⌛ این منو منقضی شده؛ لطفاً از منوی جدید انتخاب کنید.")
+    await call.message.answer("📂 دسته‌بندی خدمات:", reply_markup=catalog.menu_keyboard())
 
 # ========================
 # انتخاب دسته‌بندی
 # ========================
 @dp.callback_query_handler(lambda c: c.data.startswith("service_cat:"))
 async def show_service_items(call: types.CallbackQuery):
-    category = call.data.split(":", 1)[1]
-    kb = InlineKeyboardMarkup(row_width=2)
-    for item in SERVICES[category]:
-        kb.add(InlineKeyboardButton(item, callback_data=f"service_item:{item}"))
-    kb.add(InlineKeyboardButton("⬅️ بازگشت", callback_data="back_to_services"))
-    await call.message.edit_text(f"📌 خدمات در دسته‌ی {category}:", reply_markup=kb)
+    category_id = catalog_callback_id(call)
+    if category_id is None:
+        await answer_expired_menu(call)
+        return
+    category = catalog.category_by_id.get(category_id)
+    if not category:
+        await call.answer("❌ این دسته‌بندی دیگر وجود ندارد.", show_alert=True)
+        return
+    kb = catalog.category_keyboard(category.id)
+    await call.message.edit_text(f"📌 خدمات در دسته‌ی {category.name}:", reply_markup=kb)
     await call.answer()
 
 # ========================
@@ -836,15 +1283,25 @@ async def show_service_items(call: types.CallbackQuery):
 # ========================
 @dp.callback_query_handler(lambda c: c.data.startswith("service_item:"))
 async def request_service(call: types.CallbackQuery):
-    service = call.data.split(":", 1)[1]
+    service_id = catalog_callback_id(call)
+    if service_id is None:
+        await answer_expired_menu(call)
+        return
+    service = catalog.services.get(service_id)
+    if not service:
+        await call.answer("❌ این خدمت دیگر وجود ندارد.", show_alert=True)
+        return
 
     kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("📤 ارسال مدارک", callback_data=f"send_docs:{service}"))
+    kb.add(InlineKeyboardButton("📤 ارسال مدارک", callback_data=f"send_docs:{service.id}"))
 
+    documents = service.documents or "1️⃣ کارت ملی\n2️⃣ شناسنامه\n3️⃣ فرم تکمیل‌شده مربوطه"
+    price = f"💰 هزینه تقریبی: {service.price:,} تومان\n\n" if service.price else ""
     await call.message.answer(
-        f"✅ شما خدمت «{service}» را انتخاب کردید.\n\n"
+        f"✅ شما خدمت «{service.title}» را انتخاب کردید.\n\n"
         "📋 مدارک و اطلاعات مورد نیاز:\n"
-        "1️⃣ کارت ملی\n2️⃣ شناسنامه\n3️⃣ فرم تکمیل‌شده مربوطه\n\n"
+        f"{documents}\n\n"
+        f"{price}"
         "لطفاً پس از آماده‌سازی مدارک دکمه زیر را بزنید.",
         reply_markup=kb
     )
@@ -855,7 +1312,15 @@ async def request_service(call: types.CallbackQuery):
 # ========================
 @dp.callback_query_handler(lambda c: c.data.startswith("send_docs:"))
 async def start_sending_docs(call: types.CallbackQuery, state: FSMContext):
-    service = call.data.split(":", 1)[1]
+    service_id = catalog_callback_id(call)
+    if service_id is None:
+        await answer_expired_menu(call)
+        return
+    item = catalog.services.get(service_id)
+    if not item:
+        await call.answer("❌ این خدمت دیگر وجود ندارد.", show_alert=True)
+        return
+    service = item.title
     await state.update_data(service_name=service, docs=[])
     
     await call.message.answer(
@@ -872,26 +1337,24 @@ async def start_sending_docs(call: types.CallbackQuery, state: FSMContext):
 
 @dp.message_handler(state=ServiceOrder.waiting_for_docs, content_types=types.ContentTypes.ANY)
 async def collect_docs(msg: types.Message, state: FSMContext):
-    data = await state.get_data()
-    docs = data.get("docs", [])
-
     if msg.content_type == "text":
-        docs.append({"type": "text", "text": msg.text})
+        doc = {"type": "text", "text": msg.text}
     elif msg.content_type == "photo":
         file_id = msg.photo[-1].file_id
-        docs.append({"type": "photo", "file_id": file_id, "caption": msg.caption})
+        doc = {"type": "photo", "file_id": file_id, "caption": msg.caption}
     elif msg.content_type == "document":
-        docs.append({
+        doc = {
             "type": "document",
             "file_id": msg.document.file_id,
             "file_name": msg.document.file_name,
             "caption": msg.caption
-        })
+        }
     else:
         # fallback: ذخیره نوع پیام و متن (در صورت نیاز)
-        docs.append({"type": msg.content_type, "raw_text": msg.text or ""})
+        doc = {"type": msg.content_type, "raw_text": msg.text or ""}
 
-    await state.update_data(docs=docs)
+    # اضافه کردن مدرک به آرایه docs با یک دستور (بدون خواندن و بازنویسی کل لیست)
+    await state.storage.append_data(chat=state.chat, user=state.user, key="docs", item=doc)
     await msg.answer("✅ مدرک دریافت شد. اگر تمام شد، دکمه «درخواست نهایی» را بزنید.")
 
 
@@ -928,9 +1391,6 @@ async def finalize_order(call: types.CallbackQuery, state: FSMContext):
         parse_mode="Markdown"
     )
 
-    # پاک کردن وضعیت
-    await state.clear()
-
 
 @dp.callback_query_handler(lambda c: c.data.startswith("complete_order:"))
 async def complete_order(call: types.CallbackQuery):
@@ -946,21 +1406,65 @@ async def complete_order(call: types.CallbackQuery):
 async def admin_menu(msg: types.Message):
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add("➕ افزودن خدمات", "🗂 مدیریت خدمات")
+    kb.add("📣 ارسال همگانی", "📊 آمار")
     kb.add("🔙 بازگشت به منو اصلی")
     await msg.answer("بخش مدیریت:", reply_markup=kb)
 
 
+# ========================
+# آمار هشتگ‌ها
+# ========================
+@dp.message_handler(lambda m: m.text == "📊 آمار" and m.from_user.id in ADMINS)
+async def show_hashtag_stats(msg: types.Message):
+    async with db.read() as conn:
+        rows = await conn.fetch("""
+            SELECT h.name, COALESCE(s.subscribers, 0) AS subscribers, COALESCE(s.posts, 0) AS posts
+            FROM hashtags h
+            LEFT JOIN hashtag_stats s ON s.hashtag_id = h.id
+            ORDER BY subscribers DESC, posts DESC, h.name
+            LIMIT 50
+        """)
+    if not rows:
+        await msg.answer("هنوز هیچ هشتگی ثبت نشده است.")
+        return
+    lines = [f"{r['name']} — 👥 {r['subscribers']}  📰 {r['posts']}" for r in rows]
+    await msg.answer(f"📊 آمار هشتگ‌ها (👥 مشترک، 📰 پست) — {len(known_users)} کاربر:\n\n" + "\n".join(lines))
+
+
+# ========================
+# ارسال همگانی
+# ========================
+@dp.message_handler(lambda m: m.text == "📣 ارسال همگانی" and m.from_user.id in ADMINS)
+async def broadcast_start(msg: types.Message):
+    kb = ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add("🔙 انصراف")
+    await Broadcast.waiting_for_message.set()
+    await msg.answer("پیامی که باید برای همهٔ کاربران ارسال شود را بفرستید:", reply_markup=kb)
+
+@dp.message_handler(state=Broadcast.waiting_for_message, content_types=types.ContentTypes.ANY)
+async def broadcast_message(msg: types.Message, state: FSMContext):
+    await state.finish()
+    if msg.text == "🔙 انصراف":
+        await msg.answer("❌ ارسال همگانی لغو شد.", reply_markup=main_menu_keyboard(msg.from_user.id))
+        return
+
+    # پیام ادمین از همین چت برای همه کپی میشه؛ پیشرفت کار در جدول broadcasts ذخیره میشه
+    broadcast_id = await broadcaster.create(msg.chat.id, msg.message_id)
+    broadcaster.start(broadcast_id)
+    await msg.answer(
+        f"📣 ارسال همگانی #{broadcast_id} شروع شد. گزارش پیشرفت همین‌جا به‌روز میشه.",
+        reply_markup=main_menu_keyboard(msg.from_user.id)
+    )
+
+
 # ========================
 # انتخاب دسته بندی
 # ========================
 @dp.message_handler(lambda m: m.text == "➕ افزودن خدمات", user_id=ADMINS)
 async def add_service_start(msg: types.Message):
-    # گرفتن دسته‌بندی‌ها از دیتابیس
-    async with db_pool.acquire() as conn:
-    cats = await conn.fetch("SELECT * FROM service_categories")
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
-    for c in cats:
-        kb.add(c["name"])
+    for c in get_all_categories():
+        kb.add(c.name)
     kb.add("🔙 انصراف")
     await AddService.waiting_for_category.set()
     await msg.answer("یک دسته‌بندی انتخاب کنید:", reply_markup=kb)
@@ -970,12 +1474,16 @@ async def add_service_start(msg: types.Message):
 # ========================
 @dp.message_handler(state=AddService.waiting_for_category)
 async def add_service_category(msg: types.Message, state: FSMContext):
-    cat_name = msg.text.strip()
-    category = await db.fetchrow("SELECT * FROM service_categories WHERE name=$1", cat_name)
+    cat_name = (msg.text or "").strip()
+    if cat_name == "🔙 انصراف":
+        await state.finish()
+        await msg.answer("❌ لغو شد.", reply_markup=main_menu_keyboard(msg.from_user.id))
+        return
+    category = catalog.category_by_name.get(cat_name)
     if not category:
         await msg.answer("❌ دسته‌بندی معتبر نیست. دوباره انتخاب کنید.")
         return
-    await state.update_data(category_id=category["id"])
+    await state.update_data(category_id=category.id)
     await AddService.waiting_for_title.set()
     await msg.answer("عنوان خدمت را وارد کنید:")
 
@@ -997,6 +1505,27 @@ async def add_service_docs(message: types.Message, state: FSMContext):
     await message.answer("💰 هزینه تقریبی خدمت را وارد کنید (به تومان):")
     await AddService.waiting_for_price.set()
 
+@dp.message_handler(state=AddService.waiting_for_price)
+async def add_service_price(message: types.Message, state: FSMContext):
+    text = (message.text or "").strip().replace(",", "")
+    if not text.isdigit():
+        await message.answer("❌ لطفاً هزینه را فقط به صورت عدد وارد کنید.")
+        return
+    data = await state.get_data()
+    # ذخیره در دیتابیس؛ کش کاتالوگ همین‌جا و بقیه worker ها با polling نسخه به‌روز میشن
+    service_id = await catalog.add_service(data["category_id"], data["title"], data.get("documents"), int(text))
+    await state.finish()
+    if service_id is None:
+        await message.answer(
+            f"⚠️ خدمتی با عنوان «{data['title']}» در این دسته‌بندی از قبل وجود دارد؛ چیزی ثبت نشد.",
+            reply_markup=main_menu_keyboard(message.from_user.id)
+        )
+        return
+    await message.answer(
+        f"✅ خدمت «{data['title']}» ثبت شد.",
+        reply_markup=main_menu_keyboard(message.from_user.id)
+    )
+
 
 
 # --- تنظیمات تعداد پست ---
@@ -1004,8 +1533,50 @@ async def add_service_docs(message: types.Message, state: FSMContext):
 async def show_settings_menu(msg: types.Message):
     kb = InlineKeyboardMarkup(row_width=1)
     kb.add(InlineKeyboardButton("🔢 تعداد پست در هر جستجو", callback_data="set_search_limit"))
+    kb.add(InlineKeyboardButton("📬 نحوهٔ دریافت اطلاعیه‌ها", callback_data="delivery_menu"))
     await msg.answer("⚙️ تنظیمات ربات:", reply_markup=kb)
 
+DELIVERY_LABELS = {
+    INSTANT: "⚡️ فوری",
+    HOURLY: "🕐 خلاصهٔ ساعتی",
+    DAILY: "📅 خلاصهٔ روزانه",
+}
+
+def delivery_keyboard(current: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup(row_width=1)
+    for mode in DELIVERY_MODES:
+        mark = "✅ " if mode == current else ""
+        kb.add(InlineKeyboardButton(mark + DELIVERY_LABELS[mode], callback_data=f"delivery:{mode}"))
+    return kb
+
+@dp.callback_query_handler(lambda c: c.data == "delivery_menu")
+async def callback_delivery_menu(call: types.CallbackQuery):
+    if not await is_registered(call.from_user.id):
+        await call.answer("⚠️ لطفاً ابتدا در ربات ثبت‌نام کنید.", show_alert=True)
+        return
+    async with db_pool.acquire() as conn:
+        current = await conn.fetchval("SELECT delivery_mode FROM users WHERE user_id=$1", call.from_user.id)
+    await call.message.answer("📬 اطلاعیه‌های هشتگ‌های شما چطور ارسال بشن؟", reply_markup=delivery_keyboard(current))
+    await call.answer()
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("delivery:"))
+async def callback_set_delivery(call: types.CallbackQuery):
+    mode = call.data.split(":", 1)[1]
+    if mode not in DELIVERY_MODES:
+        await call.answer()
+        return
+    async with db_pool.acquire() as conn:
+        # شروع پنجرهٔ خلاصه از همین لحظه، تا پست‌هایی که قبلاً فوری رسیدن تکرار نشن
+        status = await conn.execute(
+            "UPDATE users SET delivery_mode=$2, last_digest_at=NOW() WHERE user_id=$1",
+            call.from_user.id, mode
+        )
+    if status == "UPDATE 0":
+        await call.answer("⚠️ لطفاً ابتدا در ربات ثبت‌نام کنید. (📝 ثبت‌نام در ربات)", show_alert=True)
+        return
+    await call.message.edit_reply_markup(reply_markup=delivery_keyboard(mode))
+    await call.answer("✅ ذخیره شد")
+
 @dp.callback_query_handler(lambda c: c.data == "set_search_limit")
 async def callback_set_search_limit(call: types.CallbackQuery):
     waiting_for_limit[call.from_user.id] = True
@@ -1025,9 +1596,86 @@ async def handle_set_search_limit(msg: types.Message):
     except ValueError:
         await msg.answer("❌ لطفاً یک عدد معتبر وارد کنید.")
 
+# --- آمار محدودسازی درخواست‌ها (ادمین) ---
+@dp.message_handler(commands=["throttling"], user_id=ADMINS)
+async def show_throttling_stats(msg: types.Message):
+    stats = throttling.stats()
+    if not stats:
+        await msg.answer("هیچ درخواستی محدود نشده است.")
+        return
+    lines = [
+        f"{key}: ⏸ {c.get('deferred', 0)} تأخیری، ⛔️ {c.get('dropped', 0)} حذف‌شده"
+        for key, c in sorted(stats.items())
+    ]
+    await msg.answer("📉 محدودسازی درخواست‌ها:\n" + "\n".join(lines))
+
+# --- وضعیت اتصال‌های HTTP به Bot API (ادمین) ---
+@dp.message_handler(commands=["apistats"], user_id=ADMINS)
+async def show_api_stats(msg: types.Message):
+    s = bot.transport_stats()
+    await msg.answer(
+        f"🌐 درخواست‌ها: {s['requests']} (در جریان: {s['in_flight']}، بیشینه: {s['peak_in_flight']})\n"
+        f"⏱ timeout: {s['timeouts']}\n"
+        f"🔌 اتصال جدید: {s['connections_created']}، استفادهٔ مجدد: {s['connections_reused']} "
+        f"({s['reuse_ratio']:.0%})"
+    )
+
+# --- صف پردازش آپدیت‌ها (ادمین) ---
+@dp.message_handler(commands=["queues"], user_id=ADMINS)
+async def show_queue_stats(msg: types.Message):
+    s = dp.scheduler_stats()
+    c = catchup.counters
+    await msg.answer(
+        f"📥 در صف: {s['pending']} (بیشینه: {s.get('peak_pending', 0)})\n"
+        f"💬 چت‌های فعال: {s['chats']} (بیشینه: {s.get('peak_chats', 0)})\n"
+        f"✅ پردازش‌شده: {s.get('processed', 0)}   ❌ خطا: {s.get('errors', 0)}   "
+        f"⛔️ حذف‌شده (صف پر): {s.get('dropped', 0)}\n"
+        f"⏪ catch-up: {c['posts']} پست ایندکس، {c['delivered_posts']} پست ارسال، {c['dropped']} آپدیت قدیمی حذف"
+    )
+
+# --- مسیر‌یابی کوئری‌ها بین primary و replica (ادمین) ---
+@dp.message_handler(commands=["dbstats"], user_id=ADMINS)
+async def show_db_stats(msg: types.Message):
+    s = db.stats()
+    if not s["replica_configured"]:
+        await msg.answer("replica تنظیم نشده؛ همهٔ کوئری‌ها به primary میرن.")
+        return
+    await msg.answer(
+        f"🗄 replica: {'✅ فعال' if s['replica_up'] else '⛔️ قطع'}\n"
+        f"خواندن از replica: {s['replica']}\n"
+        f"primary: {s['primary']}\n"
+        f"برگشت به primary: {s['fallback']} (خطای replica: {s['replica_errors']})\n"
+        f"replica شلوغ (فقط همون خواندن به primary): {s['busy']}"
+    )
+
+# --- پروفایل ربات در حال اجرا (ادمین) ---
+@dp.message_handler(commands=["profile"], user_id=ADMINS)
+async def cmd_profile(msg: types.Message):
+    arg = msg.get_args().strip()
+    seconds = int(arg) if arg.isdigit() else 30
+    seconds = max(1, min(seconds, 300))
+    if profiler.active:
+        await msg.answer("⏳ یک پروفایل در حال اجراست.")
+        return
+
+    async def run():
+        report = await profiler.run(seconds)
+        await bot.send_document(msg.chat.id, report.collapsed_file(), caption="🔥 collapsed stacks (flamegraph)")
+        await bot.send_message(msg.chat.id, report.summary())
+
+    asyncio.create_task(run())
+    await msg.answer(f"⏱ پروفایل به مدت {seconds} ثانیه شروع شد...")
+
 # ----------------- startup/shutdown -----------------
 
 async def on_shutdown(dispatcher):
+    # آپدیت‌هایی که در صف موندن قبل از بستن اتصال‌ها تموم بشن
+    if not await dispatcher.drain(timeout=10):
+        logging.warning("shutting down with %s updates still queued", dispatcher.scheduler_stats()["pending"])
+    if bot_state and dispatcher.last_update_id:
+        await bot_state.set(LAST_UPDATE_ID, dispatcher.last_update_id)
+    if db:
+        await db.close()
     if db_pool:
         await db_pool.close()
     session = await bot.get_session()
@@ -1035,4 +1683,5 @@ async def on_shutdown(dispatcher):
     print("بوت خاموش شد.")
 
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
+    # آپدیت‌های زمان خاموشی رو catchup در on_startup پردازش می‌کنه، skip_updates لازم نیست
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
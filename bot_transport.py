@@ -0,0 +1,92 @@
+# bot_transport.py
+import asyncio
+import aiohttp
+from typing import Dict, Optional
+from aiogram import Bot
+from aiogram.utils import json
+
+
+class TunedBot(Bot):
+    """
+    aiogram Bot whose single aiohttp session is tuned for fan-out.
+
+    - one connection pool of ``connections_limit`` keep-alive connections
+      (kept open ``keepalive_timeout`` seconds) and a DNS cache of
+      ``dns_cache_ttl`` seconds;
+    - a per-call timeout: ``upload_timeout`` for requests carrying files,
+      ``api_timeout`` for every other method except long-polling
+      ``getUpdates``, which keeps the timeout the dispatcher gives it;
+    - counters for requests in flight, timeouts and new vs. reused
+      connections, see ``transport_stats``.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        connections_limit: int = 100,
+        keepalive_timeout: float = 60,
+        dns_cache_ttl: int = 300,
+        api_timeout: Optional[float] = 10,
+        upload_timeout: Optional[float] = 60,
+        **kwargs,
+    ):
+        super().__init__(token, connections_limit=connections_limit, **kwargs)
+        self._connector_init.update(
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_cache_ttl,
+        )
+        self.api_timeout = self._prepare_timeout(api_timeout)
+        self.upload_timeout = self._prepare_timeout(upload_timeout)
+        self.counters: Dict[str, int] = {
+            "requests": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+        }
+
+    async def get_new_session(self) -> aiohttp.ClientSession:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_connection_created)
+        trace.on_connection_reuseconn.append(self._on_connection_reused)
+        # same session as Bot.get_new_session, plus connection tracing
+        return aiohttp.ClientSession(
+            connector=self._connector_class(**self._connector_init),
+            json_serialize=json.dumps,
+            trace_configs=[trace],
+        )
+
+    async def _on_connection_created(self, session, ctx, params):
+        self.counters["connections_created"] += 1
+
+    async def _on_connection_reused(self, session, ctx, params):
+        self.counters["connections_reused"] += 1
+
+    def _timeout_for(self, method: str, files) -> Optional[aiohttp.ClientTimeout]:
+        if method.lower() == "getupdates" or self._ctx_timeout.get(None) is not None:
+            return None
+        return self.upload_timeout if files else self.api_timeout
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        c = self.counters
+        c["requests"] += 1
+        c["in_flight"] += 1
+        c["peak_in_flight"] = max(c["peak_in_flight"], c["in_flight"])
+        try:
+            timeout = self._timeout_for(method, files)
+            if timeout is None:
+                return await super().request(method, data, files, **kwargs)
+            with self.request_timeout(timeout):
+                return await super().request(method, data, files, **kwargs)
+        except asyncio.TimeoutError:
+            c["timeouts"] += 1
+            raise
+        finally:
+            c["in_flight"] -= 1
+
+    def transport_stats(self) -> Dict[str, float]:
+        c = self.counters
+        opened = c["connections_created"] + c["connections_reused"]
+        return {**c, "reuse_ratio": c["connections_reused"] / opened if opened else 0.0}
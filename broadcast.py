@@ -0,0 +1,195 @@
+# broadcast.py
+import time
+import asyncio
+import logging
+import asyncpg
+from typing import Dict, List, Optional
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+from recipients import DeadRecipients
+
+# first key of the two-int advisory lock that marks a broadcast as owned
+BROADCAST_LOCK_NS = 0x62726463
+
+
+class RateLimiter:
+    """Spaces calls to ``wait`` at least ``1 / rate`` seconds apart."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+
+class Broadcaster:
+    """
+    Copies one message to every row of ``users``.
+
+    Recipients are read in user_id order, one keyset page of
+    ``chunk_size`` per short query, and sent through a rate-limited,
+    bounded-concurrency pipeline. No transaction stays open while sending,
+    so a broadcast of several hours doesn't hold back vacuum. After every
+    chunk the last user_id and counters are checkpointed in ``broadcasts``,
+    so an interrupted broadcast resumes from that chunk.
+    Progress (throughput and ETA) is edited into a status message in the
+    admin's chat.
+    """
+
+    def __init__(self, bot: Bot, pool: asyncpg.pool.Pool, rate: float = 25.0,
+                 concurrency: int = 10, chunk_size: int = 500, report_every: float = 5.0,
+                 dead: Optional[DeadRecipients] = None):
+        self.bot = bot
+        self.pool = pool
+        self.dead = dead or DeadRecipients(pool)
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.report_every = report_every
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    async def create(self, from_chat_id: int, message_id: int) -> int:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(
+                "INSERT INTO broadcasts(from_chat_id, message_id) VALUES($1, $2) RETURNING id",
+                from_chat_id,
+                message_id,
+            )
+
+    def start(self, broadcast_id: int) -> asyncio.Task:
+        task = self.tasks.get(broadcast_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self._run(broadcast_id))
+            self.tasks[broadcast_id] = task
+        return task
+
+    async def resume_pending(self) -> List[int]:
+        """Restart broadcasts that were still running when the bot stopped."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")
+        for r in rows:
+            self.start(r["id"])
+        return [r["id"] for r in rows]
+
+    async def _send(self, user_id: int, from_chat_id: int, message_id: int) -> bool:
+        for _ in range(3):
+            await self.limiter.wait()
+            try:
+                await self.bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(e.timeout)
+            except TelegramAPIError as e:
+                self.dead.record(user_id, e)
+                return False
+        return False
+
+    async def _send_chunk(self, user_ids: List[int], from_chat_id: int, message_id: int) -> int:
+        """Send to a chunk of users; returns the number of successful sends."""
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(uid):
+            async with sem:
+                return await self._send(uid, from_chat_id, message_id)
+
+        results = await asyncio.gather(*(one(uid) for uid in user_ids))
+        return sum(results)
+
+    async def _report(self, chat_id: int, status_msg: Optional[int], text: str) -> Optional[int]:
+        try:
+            if status_msg is None:
+                return (await self.bot.send_message(chat_id, text)).message_id
+            await self.bot.edit_message_text(text, chat_id, status_msg)
+        except TelegramAPIError:
+            pass
+        return status_msg
+
+    async def _run(self, broadcast_id: int):
+        async with self.pool.acquire() as conn:
+            # only one process may run a given broadcast
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", BROADCAST_LOCK_NS, broadcast_id):
+                return
+            try:
+                await self._run_locked(broadcast_id)
+            except Exception:
+                logging.exception("broadcast %s failed", broadcast_id)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1, $2)", BROADCAST_LOCK_NS, broadcast_id)
+                self.tasks.pop(broadcast_id, None)
+
+    async def _run_locked(self, broadcast_id: int):
+        async with self.pool.acquire() as conn:
+            b = await conn.fetchrow("SELECT * FROM broadcasts WHERE id=$1", broadcast_id)
+            if not b or b["status"] != "running":
+                return
+            remaining = await conn.fetchval(
+                "SELECT COUNT(*) FROM users WHERE user_id > $1 AND dead_at IS NULL", b["last_user_id"]
+            )
+        admin_chat, message_id = b["from_chat_id"], b["message_id"]
+        sent, failed = b["sent"], b["failed"]
+        last_user_id = b["last_user_id"]
+
+        started = time.monotonic()
+        done_now = 0
+        last_report = 0.0
+        status_msg = await self._report(admin_chat, None, f"📣 ارسال همگانی #{broadcast_id}: {remaining} گیرنده")
+
+        while True:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT user_id FROM users
+                    WHERE user_id > $1 AND dead_at IS NULL
+                    ORDER BY user_id
+                    LIMIT $2
+                    """,
+                    last_user_id,
+                    self.chunk_size,
+                )
+            if not rows:
+                break
+            user_ids = [r["user_id"] for r in rows]
+            ok = await self._send_chunk(user_ids, admin_chat, message_id)
+            sent += ok
+            failed += len(user_ids) - ok
+            done_now += len(user_ids)
+            last_user_id = user_ids[-1]
+
+            await self.dead.flush()
+            async with self.pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    UPDATE broadcasts SET last_user_id=$2, sent=$3, failed=$4, updated_at=NOW()
+                    WHERE id=$1
+                    """,
+                    broadcast_id, last_user_id, sent, failed,
+                )
+
+            elapsed = time.monotonic() - started
+            if elapsed - last_report >= self.report_every:
+                last_report = elapsed
+                rate = done_now / elapsed if elapsed else 0.0
+                eta = (remaining - done_now) / rate if rate else 0.0
+                status_msg = await self._report(
+                    admin_chat, status_msg,
+                    f"📣 ارسال همگانی #{broadcast_id}\n"
+                    f"✅ {sent}   ❌ {failed}   ⏳ {max(remaining - done_now, 0)}\n"
+                    f"⚡️ {rate:.1f} پیام/ثانیه — زمان باقی‌مانده ≈ {int(eta)} ثانیه",
+                )
+
+        async with self.pool.acquire() as wconn:
+            await wconn.execute(
+                "UPDATE broadcasts SET status='done', updated_at=NOW() WHERE id=$1", broadcast_id
+            )
+        await self._report(
+            admin_chat, status_msg,
+            f"🏁 ارسال همگانی #{broadcast_id} تمام شد.\n✅ {sent}   ❌ {failed}",
+        )
@@ -0,0 +1,239 @@
+# catchup.py
+import time
+import asyncio
+import logging
+import asyncpg
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from aiogram import Bot, types
+from broadcast import RateLimiter
+from channel_posts import parse_channel_post
+from import_channel_export import load_batch
+from recipients import DeadRecipients
+from scheduler import OrderedDispatcher
+
+# bot_state keys
+LAST_UPDATE_ID = "last_update_id"
+# every indexed channel post up to this message_id reached its subscribers
+LAST_CHANNEL_MESSAGE_ID = "last_channel_message_id"
+
+# getUpdates returns at most 100 updates per call
+BATCH_SIZE = 100
+
+
+class BotState:
+    """Named BIGINT values in ``bot_state`` that must survive restarts."""
+
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+
+    async def get(self, key: str) -> Optional[int]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT value FROM bot_state WHERE key = $1", key)
+
+    async def set(self, key: str, value: int) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO bot_state(key, value) VALUES($1, $2)
+                ON CONFLICT(key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
+                """,
+                key,
+                value,
+            )
+
+    async def advance(self, key: str, value: int) -> None:
+        """Like ``set``, but never moves the value backwards."""
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO bot_state(key, value) VALUES($1, $2)
+                ON CONFLICT(key) DO UPDATE SET value = GREATEST(bot_state.value, EXCLUDED.value),
+                                               updated_at = now()
+                """,
+                key,
+                value,
+            )
+
+
+class ChannelCatchUp:
+    """
+    Replaces ``skip_updates=True``: nothing the channel posted while the bot
+    was down is lost (Telegram keeps pending updates for 24 hours).
+
+    ``ingest`` runs before polling starts and drains the pending updates a
+    getUpdates batch at a time. Channel posts (and edits) of the batch are
+    bulk-indexed with ``import_channel_export.load_batch`` before the next
+    call acknowledges them. Membership changes and messages sent after the
+    start are handed to the dispatcher. Stale interactions (older messages,
+    button presses, inline queries) are dropped.
+
+    ``deliver`` then fans every indexed post newer than
+    ``last_channel_message_id`` and younger than ``max_age`` seconds out to
+    the instant subscribers of its hashtags, through ``limiter`` with at most
+    ``concurrency`` sends in flight, advancing the mark post by post so a
+    restart resumes where it stopped. ``done`` is set when it finishes;
+    live channel posts wait for it so subscribers get posts in order.
+    """
+
+    def __init__(self, bot: Bot, pool: asyncpg.pool.Pool, dispatcher: OrderedDispatcher, channel_id: int,
+                 state: BotState, limiter: RateLimiter, dead: DeadRecipients,
+                 concurrency: int = 10, max_age: float = 86400):
+        self.bot = bot
+        self.pool = pool
+        self.dispatcher = dispatcher
+        self.channel_id = channel_id
+        self.state = state
+        self.limiter = limiter
+        self.dead = dead
+        self.concurrency = concurrency
+        self.max_age = max_age
+        self.done = asyncio.Event()
+        self.counters: Counter = Counter()
+
+    async def ingest(self) -> int:
+        """Drain pending updates; returns the number of channel posts indexed."""
+        started = time.time()
+        last_update_id = await self.state.get(LAST_UPDATE_ID)
+        if await self.state.get(LAST_CHANNEL_MESSAGE_ID) is None:
+            # first start with catch-up: everything indexed so far was delivered live
+            async with self.pool.acquire() as conn:
+                indexed = await conn.fetchval("SELECT MAX(message_id) FROM posts")
+            await self.state.advance(LAST_CHANNEL_MESSAGE_ID, indexed or 0)
+
+        offset = None
+        first = None
+        while True:
+            # offset acknowledges everything before it, so a batch is only
+            # confirmed after it was indexed
+            updates = await self.bot.get_updates(offset=offset, limit=BATCH_SIZE, timeout=0)
+            if not updates:
+                break
+            if first is None:
+                first = updates[0].update_id
+            posts: Dict[int, Tuple] = {}
+            tags: Dict[int, Set[str]] = {}
+            for update in updates:
+                self._sort(update, started, posts, tags)
+            if posts:
+                await self._load(posts, tags)
+            offset = updates[-1].update_id + 1
+            await self.state.set(LAST_UPDATE_ID, updates[-1].update_id)
+
+        if offset is not None:
+            # dropped updates count as handled for the checkpoint
+            self.dispatcher.last_update_id = max(self.dispatcher.last_update_id, offset - 1)
+        if first is not None and last_update_id is not None and first > last_update_id + 1:
+            logging.warning(
+                "%s updates after the checkpointed update %s were no longer pending (expired after 24h "
+                "or lost in a crash); backfill missing channel posts with import_channel_export.py",
+                first - last_update_id - 1, last_update_id,
+            )
+        c = self.counters
+        if offset is not None:
+            logging.info(
+                "catch-up: %s channel posts indexed, %s updates handed to the dispatcher, %s stale dropped",
+                c["posts"], c["forwarded"], c["dropped"],
+            )
+        return c["posts"]
+
+    def _sort(self, update: types.Update, started: float,
+              posts: Dict[int, Tuple], tags: Dict[int, Set[str]]) -> None:
+        post = update.channel_post or update.edited_channel_post
+        if post:
+            if post.chat.id != self.channel_id:
+                return
+            parsed = parse_channel_post(post.text or post.caption)
+            if not parsed:
+                return
+            # a later edit of the same post in the batch wins
+            posts[post.message_id] = (post.message_id, parsed.title, parsed.content, post.date.timestamp())
+            tags[post.message_id] = set(parsed.tags)
+            self.counters["posts"] += 1
+            return
+        message = update.message or update.edited_message
+        if update.my_chat_member or (message and message.date.timestamp() >= started):
+            self.dispatcher.enqueue(update)
+            self.counters["forwarded"] += 1
+            return
+        self.counters["dropped"] += 1
+
+    async def _load(self, posts: Dict[int, Tuple], tags: Dict[int, Set[str]]) -> None:
+        async with self.pool.acquire() as conn:
+            # posts.created_at is a local TIMESTAMP: convert the post dates the way now() is
+            created = await conn.fetchval(
+                "SELECT array_agg(to_timestamp(d)::timestamp ORDER BY n) FROM unnest($1::float8[]) WITH ORDINALITY AS t(d, n)",
+                [p[3] for p in posts.values()],
+            )
+            await load_batch(
+                conn,
+                [(*p[:3], c) for p, c in zip(posts.values(), created)],
+                [(mid, t) for mid, names in tags.items() for t in names],
+            )
+
+    async def deliver(self, subscribers: Callable[[List[str]], Awaitable[List[int]]],
+                      send: Callable[[int, int, List[str]], Awaitable[bool]]) -> int:
+        """
+        Fan the missed posts out; ``subscribers(tags)`` lists the recipients
+        and ``send(user_id, message_id, tags)`` delivers one copy. Returns
+        the number of posts delivered.
+        """
+        try:
+            return await self._deliver(subscribers, send)
+        finally:
+            self.done.set()
+
+    async def _deliver(self, subscribers, send) -> int:
+        since = await self.state.get(LAST_CHANNEL_MESSAGE_ID) or 0
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT p.message_id, array_agg(h.name ORDER BY h.name) AS tags
+                FROM posts p
+                JOIN post_hashtags ph ON ph.post_id = p.id AND ph.created_at = p.created_at
+                JOIN hashtags h ON h.id = ph.hashtag_id
+                WHERE p.message_id > $1
+                  AND p.created_at > now() - make_interval(secs => $2)
+                  AND ph.created_at > now() - make_interval(secs => $2)
+                GROUP BY p.message_id
+                ORDER BY p.message_id
+                """,
+                since,
+                self.max_age,
+            )
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(uid, message_id, tags):
+            async with sem:
+                await self.limiter.wait()
+                return await send(uid, message_id, tags)
+
+        for r in rows:
+            users = await subscribers(r["tags"])
+            results = await asyncio.gather(*(one(uid, r["message_id"], r["tags"]) for uid in users))
+            await self.dead.flush()
+            await self.state.advance(LAST_CHANNEL_MESSAGE_ID, r["message_id"])
+            self.counters["delivered_posts"] += 1
+            self.counters["sent"] += sum(results)
+            self.counters["failed"] += len(results) - sum(results)
+        if rows:
+            logging.info(
+                "catch-up: %s missed posts delivered (%s sent, %s failed)",
+                len(rows), self.counters["sent"], self.counters["failed"],
+            )
+        return len(rows)
+
+
+async def checkpoint_updates(state: BotState, dispatcher: OrderedDispatcher, interval: float = 60) -> None:
+    """Persist the dispatcher's last processed update_id every ``interval`` seconds."""
+    saved = dispatcher.last_update_id
+    while True:
+        await asyncio.sleep(interval)
+        current = dispatcher.last_update_id
+        if current == saved:
+            continue
+        try:
+            await state.set(LAST_UPDATE_ID, current)
+            saved = current
+        except Exception:
+            logging.exception("saving the last update id failed")
@@ -0,0 +1,29 @@
+# channel_posts.py
+import re
+from typing import List, NamedTuple, Optional
+
+TITLE_MARK = "📌"
+HASHTAG_RE = re.compile(r"#\S+")
+
+
+class ParsedPost(NamedTuple):
+    title: str
+    content: str
+    tags: List[str]
+
+
+def parse_channel_post(text: Optional[str]) -> Optional[ParsedPost]:
+    """
+    Parse a channel post the way the bot indexes it: the first line must start
+    with 📌 and becomes the title, the rest is the content and every #word in
+    the text is a hashtag. Returns None for posts that are not indexed.
+    """
+    if not text:
+        return None
+    lines = text.splitlines()
+    first_line = lines[0].strip()
+    if not first_line.startswith(TITLE_MARK):
+        return None
+    title = re.sub(r"^📌\s*", "", first_line).strip()
+    content = "\n".join(lines[1:]).strip()
+    return ParsedPost(title, content, HASHTAG_RE.findall(text))
@@ -0,0 +1,143 @@
+# db_router.py
+import time
+import asyncio
+import logging
+import asyncpg
+from typing import Callable, Dict, Optional
+
+# errors that mean "this server is unreachable", not "this query is wrong"
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+)
+
+
+class DBRouter:
+    """
+    Routes queries between the primary pool and an optional read replica.
+
+    ``write()`` (and anything that must see its own writes) always uses the
+    primary. ``read()`` uses the replica when one is configured and healthy;
+    if the replica cannot be reached it is marked down for ``retry_after``
+    seconds and reads fall back to the primary in the meantime. A replica
+    pool that is merely busy (acquire timed out) sends just that read to
+    the primary; only ``max_busy`` timeouts in a row (e.g. a host that
+    silently drops packets) count as down.
+    """
+
+    def __init__(
+        self,
+        primary: asyncpg.pool.Pool,
+        replica_dsn: Optional[str] = None,
+        retry_after: float = 30.0,
+        acquire_timeout: float = 2.0,
+        max_busy: int = 5,
+        pool_init: Optional[Callable] = None,
+        **pool_kwargs,
+    ):
+        self.primary = primary
+        self.replica: Optional[asyncpg.pool.Pool] = None
+        self.replica_dsn = replica_dsn
+        self.retry_after = retry_after
+        self.acquire_timeout = acquire_timeout
+        self.max_busy = max_busy
+        self._busy_in_row = 0
+        self._pool_init = pool_init
+        self._pool_kwargs = pool_kwargs
+        self._down_until = 0.0
+        self._connect_lock = asyncio.Lock()
+        # where reads were served; "fallback" = replica failed on acquire,
+        # "busy" = its pool had no free connection within acquire_timeout
+        self.counters: Dict[str, int] = {
+            "replica": 0, "primary": 0, "fallback": 0, "busy": 0, "replica_errors": 0,
+        }
+
+    async def connect(self) -> None:
+        """Create the replica pool; a failure only disables the replica for now."""
+        if not self.replica_dsn or self.replica is not None:
+            return
+        async with self._connect_lock:
+            if self.replica is not None:
+                return
+            try:
+                self.replica = await asyncpg.create_pool(
+                    self.replica_dsn, init=self._pool_init, **self._pool_kwargs
+                )
+                logging.info("read replica pool ready")
+            except CONNECTION_ERRORS as e:
+                self.mark_down(e)
+
+    def mark_down(self, error: BaseException) -> None:
+        self.counters["replica_errors"] += 1
+        self._down_until = time.monotonic() + self.retry_after
+        logging.warning("read replica unavailable (%r); using primary for %ss", error, self.retry_after)
+
+    def replica_available(self) -> bool:
+        return bool(self.replica_dsn) and time.monotonic() >= self._down_until
+
+    def write(self):
+        """Connection from the primary: ``async with router.write() as conn``."""
+        return self.primary.acquire()
+
+    def read(self):
+        """Connection for read-only queries: ``async with router.read() as conn``."""
+        return _ReadConnection(self)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self.counters,
+            "replica_configured": bool(self.replica_dsn),
+            "replica_up": self.replica is not None and self.replica_available(),
+        }
+
+    async def close(self) -> None:
+        if self.replica is not None:
+            await self.replica.close()
+            self.replica = None
+
+
+class _ReadConnection:
+    """Acquires from the replica, falling back to the primary on connection errors."""
+
+    def __init__(self, router: DBRouter):
+        self.router = router
+        self.pool: Optional[asyncpg.pool.Pool] = None
+        self.conn = None
+
+    async def __aenter__(self):
+        router = self.router
+        if router.replica_available():
+            await router.connect()
+        if router.replica is not None and router.replica_available():
+            try:
+                self.conn = await router.replica.acquire(timeout=router.acquire_timeout)
+                self.pool = router.replica
+                router._busy_in_row = 0
+                router.counters["replica"] += 1
+                return self.conn
+            except asyncio.TimeoutError as e:
+                # busy, not down: only this read goes to the primary
+                router.counters["busy"] += 1
+                router._busy_in_row += 1
+                if router._busy_in_row >= router.max_busy:
+                    router._busy_in_row = 0
+                    router.mark_down(e)
+            except CONNECTION_ERRORS as e:
+                router.mark_down(e)
+                router.counters["fallback"] += 1
+        else:
+            router.counters["primary"] += 1
+        self.pool = router.primary
+        self.conn = await router.primary.acquire()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # a replica that dies mid-query can't be retried here, but the next
+        # reads go to the primary until it is back; a slow query is no sign of that
+        if (self.pool is self.router.replica and isinstance(exc, CONNECTION_ERRORS)
+                and not isinstance(exc, asyncio.TimeoutError)):
+            self.router.mark_down(exc)
+        await self.pool.release(self.conn)
@@ -0,0 +1,119 @@
+# digest.py
+import html
+import asyncio
+import logging
+import asyncpg
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, List, Optional
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+from broadcast import RateLimiter
+from recipients import DeadRecipients
+
+INSTANT = "instant"
+HOURLY = "hourly"
+DAILY = "daily"
+DELIVERY_MODES = (INSTANT, HOURLY, DAILY)
+
+# key of the transaction-level advisory lock that serialises digest runs
+DIGEST_LOCK_ID = 0x64676573
+
+MAX_ITEMS = 20
+
+
+async def collect_digest(pool: asyncpg.pool.Pool, mode: str) -> Dict[int, List[asyncpg.Record]]:
+    """
+    Return {user_id: [posts]} with posts on each ``mode`` user's subscribed
+    hashtags created since that user's previous digest and up to now, and
+    advance last_digest_at. Both happen in one transaction so concurrent
+    workers cannot pick up the same window twice.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", DIGEST_LOCK_ID):
+                return {}
+            # posts.created_at and last_digest_at are the database's local
+            # TIMESTAMPs: take the cutoff from its clock, not this host's
+            cutoff = await conn.fetchval("SELECT now()::timestamp")
+            rows = await conn.fetch(
+                """
+                SELECT DISTINCT s.user_id, p.message_id, p.title, p.created_at
+                FROM users u
+                JOIN subscriptions s ON s.user_id = u.user_id
+                JOIN post_hashtags ph ON ph.hashtag_id = s.hashtag_id
+                JOIN posts p ON p.id = ph.post_id AND p.created_at = ph.created_at
+                WHERE u.delivery_mode = $1
+                  AND u.dead_at IS NULL
+                  AND p.created_at > COALESCE(u.last_digest_at, u.created_at)
+                  AND p.created_at <= $2
+                  -- lets the planner skip partitions older than any digest window
+                  AND ph.created_at > (SELECT MIN(COALESCE(last_digest_at, created_at))
+                                       FROM users WHERE delivery_mode = $1)
+                  AND ph.created_at <= $2
+                ORDER BY s.user_id, p.created_at DESC
+                """,
+                mode,
+                cutoff,
+            )
+            await conn.execute(
+                "UPDATE users SET last_digest_at = $2 WHERE delivery_mode = $1",
+                mode,
+                cutoff,
+            )
+    return {uid: list(items) for uid, items in groupby(rows, key=lambda r: r["user_id"])}
+
+
+def format_digest(mode: str, posts: List[asyncpg.Record], channel_username: str) -> str:
+    header = "🗞 خلاصهٔ ساعتی اطلاعیه‌ها" if mode == HOURLY else "🗞 خلاصهٔ روزانهٔ اطلاعیه‌ها"
+    lines = [f"<b>{header}</b> ({len(posts)} مورد)", ""]
+    for p in posts[:MAX_ITEMS]:
+        title = html.escape(p["title"] or "")
+        if channel_username:
+            lines.append(f"📌 <a href='https://t.me/{channel_username}/{p['message_id']}'>{title}</a>")
+        else:
+            lines.append(f"📌 {title}")
+    if len(posts) > MAX_ITEMS:
+        lines.append(f"… و {len(posts) - MAX_ITEMS} مورد دیگر")
+    return "\n".join(lines)
+
+
+async def send_digests(bot: Bot, pool: asyncpg.pool.Pool, mode: str, limiter: RateLimiter,
+                       channel_username: str, dead: Optional[DeadRecipients] = None) -> int:
+    """Build and send one digest message per ``mode`` user; returns messages sent."""
+    digests = await collect_digest(pool, mode)
+    dead = dead or DeadRecipients(pool)
+    sent = 0
+    for user_id, posts in digests.items():
+        text = format_digest(mode, posts, channel_username)
+        for _ in range(2):
+            await limiter.wait()
+            try:
+                await bot.send_message(user_id, text, parse_mode="HTML", disable_web_page_preview=True)
+                sent += 1
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(e.timeout)
+            except TelegramAPIError as e:
+                logging.info("digest to %s failed (%s)", user_id, dead.record(user_id, e))
+                break
+    await dead.flush()
+    return sent
+
+
+async def run_digest_scheduler(bot: Bot, pool: asyncpg.pool.Pool, limiter: RateLimiter,
+                               channel_username: str, daily_hour: int = 20,
+                               dead: Optional[DeadRecipients] = None):
+    """Send hourly digests at the top of every hour and daily ones at ``daily_hour``."""
+    while True:
+        now = datetime.now()
+        next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        await asyncio.sleep((next_hour - now).total_seconds())
+        try:
+            sent = await send_digests(bot, pool, HOURLY, limiter, channel_username, dead)
+            if next_hour.hour == daily_hour:
+                sent += await send_digests(bot, pool, DAILY, limiter, channel_username, dead)
+            if sent:
+                logging.info("digests sent: %s", sent)
+        except Exception:
+            logging.exception("digest run failed")
@@ -1,45 +1,43 @@
 # fsm_storage_postgres.py
 import json
+import asyncio
+import logging
 import asyncpg
 from typing import Optional, Dict, Any
+from aiogram.dispatcher.storage import BaseStorage
 
 
-class PostgresStorage:
+class PostgresStorage(BaseStorage):
     """
     Lightweight FSM storage for aiogram v2 using asyncpg + a single table.
     Methods mirror what aiogram v2 expects: set_state, get_state, set_data,
     get_data, update_data, reset_data, reset_state (finish), close.
+
+    Rows idle for longer than ``ttl`` seconds are treated as expired and are
+    removed in batches by ``vacuum`` (see ``start_vacuum``). The
+    ``fsm_storage`` table itself is created by the migrations.
     """
 
-    def __init__(self, pool: asyncpg.pool.Pool):
+    def __init__(self, pool: asyncpg.pool.Pool, ttl: Optional[int] = None):
         self.pool = pool
-
-    async def create_table(self) -> None:
-        """Create table if not exists."""
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS fsm_storage (
-                    chat_id BIGINT NOT NULL,
-                    user_id BIGINT NOT NULL,
-                    state TEXT,
-                    data JSONB,
-                    updated_at TIMESTAMP DEFAULT now(),
-                    PRIMARY KEY (chat_id, user_id)
-                );
-                """
-            )
+        self.ttl = ttl
+        self._vacuum_task: Optional[asyncio.Task] = None
 
     def _ids(self, chat, user):
         """Normalize chat/user arguments to integers (chat_id, user_id)."""
-        if chat is None or user is None:
-            raise ValueError("chat and user must be provided")
+        # like BaseStorage.check_address: a missing one defaults to the other
+        # (e.g. channel posts have no user)
+        chat, user = self.check_address(chat=chat, user=user)
         chat_id = chat if isinstance(chat, int) else getattr(chat, "id", None)
         user_id = user if isinstance(user, int) else getattr(user, "id", None)
         if chat_id is None or user_id is None:
             raise ValueError("unable to determine chat_id/user_id")
         return int(chat_id), int(user_id)
 
+    def _ttl(self) -> float:
+        """TTL in seconds for SQL filters; 0 disables expiry."""
+        return float(self.ttl or 0)
+
     # ----- State methods -----
     async def set_state(self, chat=None, user=None, state: Optional[str] = None):
         chat_id, user_id = self._ids(chat, user)
@@ -49,36 +47,53 @@ class PostgresStorage:
                 INSERT INTO fsm_storage(chat_id, user_id, state, data, updated_at)
                 VALUES($1, $2, $3, '{}'::jsonb, NOW())
                 ON CONFLICT (chat_id,user_id)
-                DO UPDATE SET state = $3, updated_at = NOW();
-                """,
+                DO UPDATE SET state = $3,
+                              data = CASE WHEN %s THEN '{}'::jsonb ELSE fsm_storage.data END,
+                              updated_at = NOW();
+                """ % _expired("$4"),
                 chat_id,
                 user_id,
-                state,
+                self.resolve_state(state),
+                self._ttl(),
             )
 
-    async def get_state(self, chat=None, user=None) -> Optional[str]:
+    async def get_state(self, chat=None, user=None, default: Optional[str] = None) -> Optional[str]:
         chat_id, user_id = self._ids(chat, user)
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT state FROM fsm_storage WHERE chat_id=$1 AND user_id=$2",
+                """
+                SELECT state FROM fsm_storage
+                WHERE chat_id=$1 AND user_id=$2
+                  AND ($3 = 0 OR updated_at > NOW() - make_interval(secs => $3))
+                """,
                 chat_id,
                 user_id,
+                self._ttl(),
             )
-            return row["state"] if row else None
+            return row["state"] if row and row["state"] is not None else default
 
-    async def reset_state(self, chat=None, user=None):
-        """Clear state and data (like finishing the FSM)."""
+    async def reset_state(self, chat=None, user=None, with_data: Optional[bool] = True):
+        """Clear state; with data (finishing the FSM) the row is deleted."""
         chat_id, user_id = self._ids(chat, user)
         async with self.pool.acquire() as conn:
-            # here we clear state and data but keep row (or create row with empty data)
+            if with_data:
+                await conn.execute(
+                    "DELETE FROM fsm_storage WHERE chat_id=$1 AND user_id=$2",
+                    chat_id,
+                    user_id,
+                )
+                return
             await conn.execute(
                 """
-                INSERT INTO fsm_storage(chat_id, user_id, state, data, updated_at)
-                VALUES($1, $2, NULL, '{}'::jsonb, NOW())
-                ON CONFLICT (chat_id,user_id) DO UPDATE SET state=NULL, data='{}'::jsonb, updated_at=NOW();
-                """,
+                UPDATE fsm_storage
+                SET state=NULL,
+                    data=CASE WHEN %s THEN '{}'::jsonb ELSE data END,
+                    updated_at=NOW()
+                WHERE chat_id=$1 AND user_id=$2;
+                """ % _expired("$3"),
                 chat_id,
                 user_id,
+                self._ttl(),
             )
 
     # alias for compatibility
@@ -94,63 +109,182 @@ class PostgresStorage:
                 """
                 INSERT INTO fsm_storage(chat_id, user_id, state, data, updated_at)
                 VALUES($1, $2, NULL, $3::jsonb, NOW())
-                ON CONFLICT (chat_id,user_id) DO UPDATE SET data=$3::jsonb, updated_at=NOW();
-                """,
+                ON CONFLICT (chat_id,user_id) DO UPDATE SET
+                    state = CASE WHEN %s THEN NULL ELSE fsm_storage.state END,
+                    data = $3::jsonb,
+                    updated_at = NOW();
+                """ % _expired("$4"),
                 chat_id,
                 user_id,
                 payload,
+                self._ttl(),
             )
 
-    async def get_data(self, chat=None, user=None) -> Dict[str, Any]:
+    async def get_data(self, chat=None, user=None, default: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         chat_id, user_id = self._ids(chat, user)
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT data FROM fsm_storage WHERE chat_id=$1 AND user_id=$2",
+                """
+                SELECT data FROM fsm_storage
+                WHERE chat_id=$1 AND user_id=$2
+                  AND ($3 = 0 OR updated_at > NOW() - make_interval(secs => $3))
+                """,
                 chat_id,
                 user_id,
+                self._ttl(),
             )
             if not row or row["data"] is None:
-                return {}
-            return row["data"]
+                return default or {}
+            return _load(row["data"])
 
-    async def update_data(self, chat=None, user=None, data: Optional[Dict[str, Any]] = None):
+    async def update_data(self, chat=None, user=None, data: Optional[Dict[str, Any]] = None, **kwargs):
         """Merge provided dict into existing data."""
+        data = {**(data or {}), **kwargs}
         if not data:
             return
         chat_id, user_id = self._ids(chat, user)
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow(
-                "SELECT data FROM fsm_storage WHERE chat_id=$1 AND user_id=$2",
+                """
+                SELECT data FROM fsm_storage
+                WHERE chat_id=$1 AND user_id=$2
+                  AND ($3 = 0 OR updated_at > NOW() - make_interval(secs => $3))
+                """,
                 chat_id,
                 user_id,
+                self._ttl(),
             )
-            existing = row["data"] if row and row["data"] else {}
+            existing = _load(row["data"]) if row and row["data"] else {}
             # shallow merge
             merged = {**existing, **data}
             await conn.execute(
                 """
                 INSERT INTO fsm_storage(chat_id, user_id, state, data, updated_at)
                 VALUES($1, $2, NULL, $3::jsonb, NOW())
-                ON CONFLICT (chat_id,user_id) DO UPDATE SET data=$3::jsonb, updated_at=NOW();
-                """,
+                ON CONFLICT (chat_id,user_id) DO UPDATE SET
+                    state = CASE WHEN %s THEN NULL ELSE fsm_storage.state END,
+                    data = $3::jsonb,
+                    updated_at = NOW();
+                """ % _expired("$4"),
                 chat_id,
                 user_id,
                 json.dumps(merged, ensure_ascii=False),
+                self._ttl(),
             )
 
-    async def reset_data(self, chat=None, user=None):
+    async def append_data(self, chat=None, user=None, key: str = "", item: Any = None):
+        """
+        Append ``item`` to the JSON array stored under ``key`` in a single
+        statement, without reading the existing data back.
+        """
         chat_id, user_id = self._ids(chat, user)
         async with self.pool.acquire() as conn:
             await conn.execute(
                 """
                 INSERT INTO fsm_storage(chat_id, user_id, state, data, updated_at)
-                VALUES($1, $2, NULL, '{}'::jsonb, NOW())
-                ON CONFLICT (chat_id,user_id) DO UPDATE SET data='{}'::jsonb, updated_at=NOW();
-                """,
+                VALUES($1, $2, NULL, jsonb_build_object($3::text, jsonb_build_array($4::jsonb)), NOW())
+                ON CONFLICT (chat_id,user_id) DO UPDATE SET
+                    state = CASE WHEN {expired} THEN NULL ELSE fsm_storage.state END,
+                    data = CASE WHEN {expired}
+                        THEN jsonb_build_object($3::text, jsonb_build_array($4::jsonb))
+                        ELSE jsonb_set(
+                            COALESCE(fsm_storage.data, '{{}}'::jsonb),
+                            ARRAY[$3::text],
+                            COALESCE(fsm_storage.data -> $3::text, '[]'::jsonb) || jsonb_build_array($4::jsonb)
+                        )
+                    END,
+                    updated_at = NOW();
+                """.format(expired=_expired("$5")),
+                chat_id,
+                user_id,
+                key,
+                json.dumps(item, ensure_ascii=False),
+                self._ttl(),
+            )
+
+    async def reset_data(self, chat=None, user=None):
+        """Clear data; a row left with neither state nor data is deleted."""
+        chat_id, user_id = self._ids(chat, user)
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                """
+                WITH dropped AS (
+                    DELETE FROM fsm_storage
+                    WHERE chat_id=$1 AND user_id=$2 AND state IS NULL
+                )
+                UPDATE fsm_storage
+                SET state=CASE WHEN %s THEN NULL ELSE state END,
+                    data='{}'::jsonb,
+                    updated_at=NOW()
+                WHERE chat_id=$1 AND user_id=$2 AND state IS NOT NULL;
+                """ % _expired("$3"),
                 chat_id,
                 user_id,
+                self._ttl(),
             )
 
     # ----- housekeeping -----
+    async def vacuum(self, batch_size: int = 1000) -> int:
+        """
+        Delete expired rows (idle longer than ttl) and empty rows (no state,
+        no data) in batches of ``batch_size``. Returns number of deleted rows.
+        """
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                status = await conn.execute(
+                    """
+                    DELETE FROM fsm_storage WHERE ctid IN (
+                        SELECT ctid FROM fsm_storage
+                        WHERE ($1 > 0 AND updated_at < NOW() - make_interval(secs => $1))
+                           OR (state IS NULL AND (data IS NULL OR data = '{}'::jsonb))
+                        LIMIT $2
+                    );
+                    """,
+                    self._ttl(),
+                    batch_size,
+                )
+            deleted = int(status.split()[-1])
+            total += deleted
+            if deleted < batch_size:
+                return total
+            # let other coroutines run between batches
+            await asyncio.sleep(0)
+
+    def start_vacuum(self, interval: float, batch_size: int = 1000) -> None:
+        """Run ``vacuum`` every ``interval`` seconds in a background task."""
+        async def _loop():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    removed = await self.vacuum(batch_size)
+                    if removed:
+                        logging.info("fsm_storage vacuum removed %s rows", removed)
+                except Exception:
+                    logging.exception("fsm_storage vacuum failed")
+
+        if self._vacuum_task is None or self._vacuum_task.done():
+            self._vacuum_task = asyncio.create_task(_loop())
+
     async def close(self):
+        if self._vacuum_task is not None:
+            self._vacuum_task.cancel()
+            self._vacuum_task = None
         await self.pool.close()
+
+    async def wait_closed(self):
+        pass
+
+
+def _expired(ttl_param: str) -> str:
+    """
+    SQL condition: the existing row of an upsert idled past the ttl given
+    as ``ttl_param``. Such a row is rewritten from scratch so an abandoned
+    flow's state and data don't come back to life before ``vacuum`` runs.
+    """
+    return f"({ttl_param} > 0 AND fsm_storage.updated_at <= NOW() - make_interval(secs => {ttl_param}))"
+
+
+def _load(value) -> Dict[str, Any]:
+    """asyncpg returns jsonb as text unless a codec is registered."""
+    return json.loads(value) if isinstance(value, str) else dict(value)
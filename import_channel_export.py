@@ -0,0 +1,189 @@
+# import_channel_export.py
+"""
+Backfill posts/hashtags from a Telegram Desktop JSON export of the channel.
+
+    DATABASE_URL=... python import_channel_export.py result.json [--batch-size 5000]
+
+The export is streamed message by message, parsed with the same rules as the
+live channel_post_handler and bulk-loaded with COPY into temporary staging
+tables, from where it is merged into posts, hashtags and post_hashtags with a
+few set-based statements per batch.
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+
+import asyncpg
+
+from channel_posts import parse_channel_post
+from migrations import migrate
+from post_archive import POST_LOCK_NS
+
+CHUNK_SIZE = 1 << 16
+
+
+def iter_export_messages(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield the objects of the top-level "messages" array one at a time."""
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buf = ""
+        # skip ahead to the opening bracket of "messages"
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            buf += chunk
+            key = buf.find('"messages"')
+            if key != -1:
+                bracket = buf.find("[", key)
+                if bracket != -1:
+                    buf = buf[bracket + 1:]
+                    break
+            else:
+                # keep a tail in case the key is split between chunks
+                buf = buf[-16:]
+
+        eof = False
+        while True:
+            buf = buf.lstrip().lstrip(",").lstrip()
+            if buf.startswith("]"):
+                return
+            try:
+                obj, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(CHUNK_SIZE)
+                eof = not chunk
+                buf += chunk
+                continue
+            yield obj
+            buf = buf[end:]
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """Flatten the export's "text" field (a string or a list of entities)."""
+    text = message.get("text", "")
+    if isinstance(text, str):
+        return text
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+
+def iter_posts(path: str) -> Iterator[Tuple[Tuple, List[str]]]:
+    """Yield ((message_id, title, content, created_at), tags) for indexable posts."""
+    for message in iter_export_messages(path):
+        if message.get("type") != "message":
+            continue
+        parsed = parse_channel_post(message_text(message))
+        if not parsed:
+            continue
+        created_at = datetime.fromisoformat(message["date"]) if message.get("date") else datetime.now()
+        yield (int(message["id"]), parsed.title, parsed.content, created_at), parsed.tags
+
+
+async def load_batch(conn: asyncpg.Connection, posts: List[Tuple], tags: List[Tuple[int, str]]):
+    async with conn.transaction():
+        await conn.execute(
+            """
+            CREATE TEMP TABLE import_posts (
+                message_id BIGINT, title TEXT, content TEXT, created_at TIMESTAMP
+            ) ON COMMIT DROP;
+            CREATE TEMP TABLE import_tags (message_id BIGINT, name TEXT) ON COMMIT DROP;
+            """
+        )
+        await conn.copy_records_to_table("import_posts", records=posts)
+        await conn.copy_records_to_table("import_tags", records=tags)
+        # same per-message lock as save_post_and_tags, so a live post or edit
+        # of a staged message can't insert it a second time meanwhile
+        await conn.execute(
+            "SELECT pg_advisory_xact_lock($1, message_id::int)"
+            " FROM (SELECT DISTINCT message_id FROM import_posts ORDER BY message_id) m",
+            POST_LOCK_NS,
+        )
+        await conn.execute(
+            """
+            -- monthly partitions for the whole date range of this batch
+            SELECT ensure_post_partitions(MIN(created_at), MAX(created_at))
+            FROM import_posts HAVING COUNT(*) > 0;
+
+            -- message_id is not UNIQUE on the partitioned table: update the
+            -- posts that exist, insert the rest
+            UPDATE posts p SET title = i.title, content = i.content
+            FROM (SELECT DISTINCT ON (message_id) * FROM import_posts ORDER BY message_id) i
+            WHERE p.message_id = i.message_id;
+
+            INSERT INTO posts(message_id, title, content, created_at)
+            SELECT DISTINCT ON (message_id) message_id, title, content, created_at
+            FROM import_posts i
+            WHERE NOT EXISTS (SELECT 1 FROM posts p WHERE p.message_id = i.message_id)
+            ORDER BY message_id;
+
+            INSERT INTO hashtags(name)
+            SELECT DISTINCT name FROM import_tags
+            ON CONFLICT(name) DO NOTHING;
+
+            -- a re-imported (edited) post keeps only the hashtags of its new text
+            DELETE FROM post_hashtags ph
+            USING posts p, import_posts i
+            WHERE p.message_id = i.message_id
+              AND ph.post_id = p.id AND ph.created_at = p.created_at
+              AND NOT EXISTS (
+                  SELECT 1 FROM import_tags t JOIN hashtags h ON h.name = t.name
+                  WHERE t.message_id = i.message_id AND h.id = ph.hashtag_id
+              );
+
+            INSERT INTO post_hashtags(post_id, hashtag_id, created_at)
+            SELECT DISTINCT p.id, h.id, p.created_at
+            FROM import_tags t
+            JOIN posts p ON p.message_id = t.message_id
+            JOIN hashtags h ON h.name = t.name
+            ON CONFLICT DO NOTHING;
+            """
+        )
+
+
+async def run(path: str, dsn: str, batch_size: int) -> int:
+    pool = await asyncpg.create_pool(dsn=dsn, min_size=1, max_size=1)
+    total = 0
+    started = time.monotonic()
+    try:
+        await migrate(pool)
+        async with pool.acquire() as conn:
+            posts: List[Tuple] = []
+            tags: List[Tuple[int, str]] = []
+            for post, post_tags in iter_posts(path):
+                posts.append(post)
+                tags.extend((post[0], t) for t in set(post_tags))
+                if len(posts) >= batch_size:
+                    await load_batch(conn, posts, tags)
+                    total += len(posts)
+                    logging.info("imported %s posts", total)
+                    posts, tags = [], []
+            if posts:
+                await load_batch(conn, posts, tags)
+                total += len(posts)
+    finally:
+        await pool.close()
+    logging.info("done: %s posts in %.1fs", total, time.monotonic() - started)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a Telegram Desktop channel export (result.json).")
+    parser.add_argument("path", help="path to result.json")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--dsn", default=os.getenv("DATABASE_URL", "").strip())
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("DATABASE_URL (or --dsn) is required")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args.path, args.dsn, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
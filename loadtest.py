@@ -0,0 +1,389 @@
+# loadtest.py
+"""
+End-to-end load generator for the bot.
+
+Synthetic ``Update`` objects are fed straight into ``dp.process_update``
+while the bot talks to a local fake Bot API server and a local Postgres:
+
+    DATABASE_URL=postgresql://localhost/cofeenet_load \\
+        python loadtest.py --users 500 --concurrency 50 --subscribers 5000
+
+Use a throwaway database: the harness registers users, subscriptions and
+posts. Per scenario it reports throughput, latency percentiles of
+``process_update`` and the Bot API calls it caused.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import logging
+import itertools
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import web
+
+FAKE_TOKEN = "123456:LOADTESTLOADTESTLOADTESTLOADTEST"
+FAKE_CHANNEL_ID = -1001000000000
+LOAD_TAG = "#بار_تست"
+
+_ids = itertools.count(1)
+
+
+# ----------------- fake Bot API -----------------
+class FakeBotAPI:
+    """
+    Answers every Bot API method with a minimal valid result and counts calls.
+    Sends to chat ids whose last two digits are below ``blocked * 100`` fail
+    with 403 "bot was blocked by the user". ``pending`` is what getUpdates
+    returns, honouring ``offset`` like Telegram does.
+    """
+
+    def __init__(self, latency: float = 0.0, blocked: float = 0.0):
+        self.latency = latency
+        self.blocked = blocked
+        self.calls: Counter = Counter()
+        self.pending: List[dict] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if chat_id > 0 and chat_id % 100 < self.blocked * 100:
+            return web.json_response(
+                {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"},
+                status=403,
+            )
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params) -> object:
+        lower = method.lower()
+        if lower == "getupdates":
+            if params.get("offset"):
+                offset = int(params["offset"])
+                self.pending = [u for u in self.pending if u["update_id"] >= offset]
+            return self.pending[:int(params.get("limit") or 100)]
+        if lower == "getme":
+            return {"id": 123456, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        if lower == "copymessage":
+            return {"message_id": next(_ids)}
+        if lower.startswith("send") or lower.startswith("edit"):
+            chat_id = int(params.get("chat_id", 0) or 0)
+            return {
+                "message_id": next(_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# ----------------- synthetic updates -----------------
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"u{user_id}"}
+
+
+def message_update(user_id: int, text: Optional[str] = None, **extra) -> dict:
+    message = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        **extra,
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_ids),
+        "callback_query": {
+            "id": str(next(_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def inline_query_update(user_id: int, query: str, offset: str = "") -> dict:
+    return {
+        "update_id": next(_ids),
+        "inline_query": {"id": str(next(_ids)), "from": _user(user_id), "query": query, "offset": offset},
+    }
+
+
+def channel_post_update(message_id: int, text: str, date: Optional[int] = None) -> dict:
+    return {
+        "update_id": next(_ids),
+        "channel_post": {
+            "message_id": message_id,
+            "date": date or int(time.time()),
+            "chat": {"id": FAKE_CHANNEL_ID, "type": "channel", "title": "loadtest"},
+            "text": text,
+        },
+    }
+
+
+# ----------------- harness -----------------
+class LoadTest:
+    def __init__(self, app, api: FakeBotAPI, concurrency: int):
+        self.app = app
+        self.api = api
+        self.concurrency = concurrency
+        self.errors: Counter = Counter()
+
+    async def feed(self, raw: dict, latencies: List[float]) -> None:
+        from aiogram import types
+        update = types.Update.to_object(raw)
+        started = time.perf_counter()
+        try:
+            # the same per-chat ordered scheduler polling uses
+            await self.app.dp.enqueue(update)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+        latencies.append(time.perf_counter() - started)
+
+    async def run(self, name: str, users: List[int],
+                  script: Callable[[int, List[float]], Awaitable[None]]) -> dict:
+        sem = asyncio.Semaphore(self.concurrency)
+        latencies: List[float] = []
+        calls_before = Counter(self.api.calls)
+        self.errors = Counter()
+
+        async def one(uid):
+            async with sem:
+                await script(uid, latencies)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(uid) for uid in users))
+        elapsed = time.perf_counter() - started
+        calls = Counter(self.api.calls)
+        calls.subtract(calls_before)
+        return {
+            "scenario": name,
+            "updates": len(latencies),
+            "seconds": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "latency": percentiles(latencies),
+            "api_calls": {k: v for k, v in calls.items() if v},
+            "errors": dict(self.errors),
+        }
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1] * 1000}
+
+
+def print_report(result: dict) -> None:
+    lat = result["latency"]
+    print(f"\n== {result['scenario']} ==")
+    print(f"updates: {result['updates']}  time: {result['seconds']:.2f}s  "
+          f"throughput: {result['throughput']:.1f} updates/s")
+    if lat:
+        print(f"latency ms: p50 {lat['p50']:.1f}  p95 {lat['p95']:.1f}  "
+              f"p99 {lat['p99']:.1f}  max {lat['max']:.1f}")
+    print("bot api calls: " + (", ".join(f"{k}={v}" for k, v in sorted(result["api_calls"].items())) or "-"))
+    if result["errors"]:
+        print("errors: " + ", ".join(f"{k}={v}" for k, v in result["errors"].items()))
+
+
+async def seed(app, users: List[int], subscribers: int, posts: int) -> int:
+    """Register users, create LOAD_TAG with ``subscribers`` subscribers and searchable posts."""
+    async with app.db_pool.acquire() as conn:
+        await conn.copy_records_to_table(
+            "users", records=[(uid, f"u{uid}", f"u{uid}") for uid in users],
+            columns=["user_id", "username", "first_name"],
+        )
+        tag_id = await app.get_or_create_hashtag(conn, LOAD_TAG)
+        base = 10_000_000
+        await conn.execute(
+            """
+            INSERT INTO users(user_id, first_name) SELECT g, 'sub' FROM generate_series($1::bigint, $2::bigint) g
+            ON CONFLICT DO NOTHING;
+            """,
+            base, base + subscribers - 1,
+        )
+        await conn.execute(
+            """
+            INSERT INTO subscriptions(user_id, hashtag_id)
+            SELECT g, $3 FROM generate_series($1::bigint, $2::bigint) g
+            ON CONFLICT DO NOTHING;
+            """,
+            base, base + subscribers - 1, tag_id,
+        )
+    for i in range(posts):
+        await app.save_post_and_tags(900_000 + i, f"کنکور سراسری {i}", "متن", [LOAD_TAG])
+    await app.load_known_users()
+    return tag_id
+
+
+async def main(args) -> None:
+    api = FakeBotAPI(latency=args.api_latency / 1000, blocked=args.blocked)
+    url = await api.start()
+
+    # bot.py reads its configuration at import time
+    os.environ.setdefault("BOT_TOKEN", FAKE_TOKEN)
+    os.environ.setdefault("CHANNEL_ID", str(FAKE_CHANNEL_ID))
+    os.environ["BOT_API_SERVER"] = url
+    if not args.throttle:
+        os.environ["THROTTLE_DEFAULT"] = os.environ["THROTTLE_SEARCH"] = "1000000,1000000"
+    import bot as app
+    from aiogram import Bot, Dispatcher
+
+    # updates "received while the bot was down", drained by catch-up in on_startup
+    down_since = int(time.time()) - 3600
+    for i in range(args.missed_posts):
+        api.pending.append(channel_post_update(
+            down_since + i, f"📌 اطلاعیه زمان خاموشی {i}\nمتن اطلاعیه\n{LOAD_TAG}", date=down_since + i))
+        stale = message_update(1 + i, "/start")
+        stale["message"]["date"] = down_since + i
+        api.pending.append(stale)
+
+    await app.on_startup(app.dp)
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+
+    base = random.randint(1, 1_000_000) * 1000
+    users = list(range(base, base + args.users))
+    tag_id = await seed(app, users, args.subscribers, args.posts)
+    if args.missed_posts:
+        started = time.perf_counter()
+        await app.catchup.done.wait()
+        print(f"catch-up: {dict(app.catchup.counters)} in {time.perf_counter() - started:.2f}s")
+    service_id = next(iter(app.catalog.services), None)
+    harness = LoadTest(app, api, args.concurrency)
+    new_users = list(range(base + args.users, base + 2 * args.users))
+
+    async def start(uid, lat):
+        await harness.feed(message_update(uid, "/start"), lat)
+
+    async def register(uid, lat):
+        await harness.feed(message_update(uid, "📝 ثبت نام"), lat)
+
+    async def search(uid, lat):
+        await harness.feed(message_update(uid, "🔍 جستجو اطلاعیه/خبر"), lat)
+        await harness.feed(message_update(uid, "کنکور"), lat)
+
+    async def subscriptions(uid, lat):
+        await harness.feed(message_update(uid, "🔔 دریافت خودکار اطلاعیه/خبر"), lat)
+        await harness.feed(callback_update(uid, f"toggle:{tag_id}"), lat)
+        await harness.feed(callback_update(uid, f"toggle:{tag_id}"), lat)
+
+    async def order(uid, lat):
+        await harness.feed(callback_update(uid, f"send_docs:{service_id}"), lat)
+        await harness.feed(message_update(uid, "کد ملی 0012345678"), lat)
+        await harness.feed(message_update(uid, caption="کارت ملی", photo=[
+            {"file_id": "photo", "file_unique_id": "p", "width": 90, "height": 90}]), lat)
+        await harness.feed(message_update(uid, caption="فرم", document={
+            "file_id": "doc", "file_unique_id": "d", "file_name": "form.pdf"}), lat)
+        await harness.feed(callback_update(uid, "finalize_order"), lat)
+
+    async def order_burst(uid, lat):
+        # a user tapping/uploading faster than the bot answers: all updates at once
+        await asyncio.gather(
+            harness.feed(callback_update(uid, f"send_docs:{service_id}"), lat),
+            harness.feed(message_update(uid, caption="کارت ملی", photo=[
+                {"file_id": "photo", "file_unique_id": "p", "width": 90, "height": 90}]), lat),
+            harness.feed(message_update(uid, caption="فرم", document={
+                "file_id": "doc", "file_unique_id": "d", "file_name": "form.pdf"}), lat),
+            harness.feed(callback_update(uid, "finalize_order"), lat),
+        )
+
+    async def inline(uid, lat):
+        # users typing one of a few popular queries, then scrolling to the second page
+        query = random.choice(["کنکور", "کنکور سراسری", "سراسری", LOAD_TAG])
+        for n in range(1, len(query) + 1):
+            await harness.feed(inline_query_update(uid, query[:n]), lat)
+        await harness.feed(inline_query_update(uid, query, offset="20"), lat)
+
+    async def channel_post(i, lat):
+        text = f"📌 اطلاعیه بار تست {i}\nمتن اطلاعیه\n{LOAD_TAG}"
+        await harness.feed(channel_post_update(950_000 + i, text), lat)
+
+    scenarios = {
+        "start": (users, start),
+        "register": (new_users, register),
+        "search": (users, search),
+        "subscriptions": (users, subscriptions),
+        "order": (users if service_id else [], order),
+        "order_burst": (users if service_id else [], order_burst),
+        "inline": (users, inline),
+        "channel_post": (list(range(args.channel_posts)), channel_post),
+    }
+    selected = args.scenario or list(scenarios)
+    try:
+        for name in selected:
+            targets, script = scenarios[name]
+            print_report(await harness.run(name, targets, script))
+        print(f"\ndb routing: {app.db.stats()}")
+        print(f"bot api transport: {app.bot.transport_stats()}")
+        print(f"inline cache: {app.inline_cache.stats()}, posts: {app.inline_posts.stats()}")
+        print(f"update scheduler: {app.dp.scheduler_stats()}")
+    finally:
+        await app.on_shutdown(app.dp)
+        await app.dp.storage.close()
+        await api.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive dp.process_update with synthetic updates.")
+    parser.add_argument("--scenario", action="append", choices=[
+        "start", "register", "search", "subscriptions", "order", "order_burst", "inline", "channel_post"],
+        help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--users", type=int, default=200, help="virtual users per scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="users driven at once")
+    parser.add_argument("--subscribers", type=int, default=2000, help="subscribers of the channel post tag")
+    parser.add_argument("--channel-posts", type=int, default=3, help="channel posts to fan out")
+    parser.add_argument("--posts", type=int, default=50, help="searchable posts to seed")
+    parser.add_argument("--missed-posts", type=int, default=0,
+                        help="channel posts pending in getUpdates at startup, for catch-up")
+    parser.add_argument("--blocked", type=float, default=0.0,
+                        help="fraction of users that blocked the bot (sends to them fail with 403)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API latency in ms")
+    parser.add_argument("--throttle", action="store_true", help="keep the per-user throttling limits")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    if not os.getenv("DATABASE_URL"):
+        sys.exit("DATABASE_URL must point to a local throwaway Postgres database")
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,420 @@
+# migrations.py
+import logging
+import asyncpg
+from typing import List, Tuple
+
+# every schema change is appended here with the next version number;
+# applied migrations are never edited.
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (
+        1,
+        "base tables",
+        """
+        CREATE TABLE IF NOT EXISTS posts (
+            id SERIAL PRIMARY KEY,
+            message_id BIGINT UNIQUE,
+            title TEXT,
+            content TEXT,
+            created_at TIMESTAMP DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS hashtags (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS post_hashtags (
+            post_id INTEGER REFERENCES posts(id) ON DELETE CASCADE,
+            hashtag_id INTEGER REFERENCES hashtags(id) ON DELETE CASCADE,
+            PRIMARY KEY (post_id, hashtag_id)
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id BIGINT,
+            hashtag_id INTEGER REFERENCES hashtags(id) ON DELETE CASCADE,
+            PRIMARY KEY (user_id, hashtag_id)
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            created_at TIMESTAMP DEFAULT now()
+        );
+        """,
+    ),
+    (
+        2,
+        "fsm storage",
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            state TEXT,
+            data JSONB,
+            updated_at TIMESTAMP DEFAULT now(),
+            PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS fsm_storage_updated_at_idx
+            ON fsm_storage (updated_at);
+        """,
+    ),
+    (
+        3,
+        "service catalog",
+        """
+        CREATE TABLE IF NOT EXISTS service_categories (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS services (
+            id SERIAL PRIMARY KEY,
+            category_id INTEGER NOT NULL REFERENCES service_categories(id) ON DELETE CASCADE,
+            title TEXT NOT NULL,
+            documents TEXT,
+            price BIGINT
+        );
+        CREATE INDEX IF NOT EXISTS services_category_id_idx ON services (category_id);
+        """,
+    ),
+    (
+        4,
+        "broadcasts",
+        """
+        CREATE TABLE broadcasts (
+            id SERIAL PRIMARY KEY,
+            from_chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT now(),
+            updated_at TIMESTAMP DEFAULT now()
+        );
+        """,
+    ),
+    (
+        5,
+        "delivery mode",
+        """
+        ALTER TABLE users
+            ADD COLUMN delivery_mode TEXT NOT NULL DEFAULT 'instant',
+            ADD COLUMN last_digest_at TIMESTAMP;
+        CREATE INDEX users_digest_idx ON users (delivery_mode) WHERE delivery_mode <> 'instant';
+        CREATE INDEX posts_created_at_idx ON posts (created_at);
+        """,
+    ),
+    (
+        6,
+        "service catalog version",
+        """
+        -- services added twice under one category before the constraint
+        -- existed: keep the latest definition (a no-op where this already ran)
+        DELETE FROM services s USING services newer
+        WHERE newer.category_id = s.category_id AND newer.title = s.title AND newer.id > s.id;
+        ALTER TABLE services ADD CONSTRAINT services_category_title_key UNIQUE (category_id, title);
+        CREATE TABLE catalog_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO catalog_version DEFAULT VALUES;
+        CREATE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE catalog_version SET version = version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER service_categories_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON service_categories
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+        CREATE TRIGGER services_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON services
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+        """,
+    ),
+    (
+        7,
+        "hashtag stats",
+        """
+        CREATE TABLE hashtag_stats (
+            hashtag_id INTEGER PRIMARY KEY REFERENCES hashtags(id) ON DELETE CASCADE,
+            subscribers INTEGER NOT NULL DEFAULT 0,
+            posts INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO hashtag_stats(hashtag_id, subscribers, posts)
+        SELECT h.id,
+               (SELECT COUNT(*) FROM subscriptions s WHERE s.hashtag_id = h.id),
+               (SELECT COUNT(*) FROM post_hashtags ph WHERE ph.hashtag_id = h.id)
+        FROM hashtags h;
+
+        -- statement-level triggers: one aggregated upsert per statement, so
+        -- bulk loads and cascaded deletes cost one UPDATE per touched hashtag
+        CREATE FUNCTION hashtag_stats_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_TABLE_NAME = 'subscriptions' AND TG_OP = 'INSERT' THEN
+                INSERT INTO hashtag_stats AS hs (hashtag_id, subscribers)
+                SELECT hashtag_id, COUNT(*) FROM new_rows GROUP BY hashtag_id
+                ON CONFLICT (hashtag_id) DO UPDATE SET subscribers = hs.subscribers + EXCLUDED.subscribers;
+            ELSIF TG_TABLE_NAME = 'subscriptions' THEN
+                UPDATE hashtag_stats hs SET subscribers = hs.subscribers - d.n
+                FROM (SELECT hashtag_id, COUNT(*) AS n FROM old_rows GROUP BY hashtag_id) d
+                WHERE hs.hashtag_id = d.hashtag_id;
+            ELSIF TG_OP = 'INSERT' THEN
+                INSERT INTO hashtag_stats AS hs (hashtag_id, posts)
+                SELECT hashtag_id, COUNT(*) FROM new_rows GROUP BY hashtag_id
+                ON CONFLICT (hashtag_id) DO UPDATE SET posts = hs.posts + EXCLUDED.posts;
+            ELSE
+                UPDATE hashtag_stats hs SET posts = hs.posts - d.n
+                FROM (SELECT hashtag_id, COUNT(*) AS n FROM old_rows GROUP BY hashtag_id) d
+                WHERE hs.hashtag_id = d.hashtag_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER subscriptions_stats_ins AFTER INSERT ON subscriptions
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_stats_apply();
+        CREATE TRIGGER subscriptions_stats_del AFTER DELETE ON subscriptions
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_stats_apply();
+        CREATE TRIGGER post_hashtags_stats_ins AFTER INSERT ON post_hashtags
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_stats_apply();
+        CREATE TRIGGER post_hashtags_stats_del AFTER DELETE ON post_hashtags
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_stats_apply();
+        """,
+    ),
+    (
+        8,
+        "monthly post partitions",
+        """
+        -- posts/post_hashtags become RANGE(created_at) partitioned by month.
+        -- Unique keys must contain the partition key, so message_id is no
+        -- longer UNIQUE (save_post_and_tags serializes per message_id instead)
+        -- and post_hashtags carries the post's created_at for its foreign key.
+        ALTER TABLE posts RENAME TO posts_old;
+        ALTER INDEX posts_pkey RENAME TO posts_old_pkey;
+        ALTER INDEX posts_message_id_key RENAME TO posts_old_message_id_key;
+        DROP INDEX posts_created_at_idx;
+        ALTER TABLE post_hashtags RENAME TO post_hashtags_old;
+        ALTER INDEX post_hashtags_pkey RENAME TO post_hashtags_old_pkey;
+
+        CREATE TABLE posts (
+            id INTEGER NOT NULL DEFAULT nextval('posts_id_seq'),
+            message_id BIGINT,
+            title TEXT,
+            content TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        ALTER SEQUENCE posts_id_seq OWNED BY posts.id;
+        CREATE INDEX posts_created_at_idx ON posts (created_at);
+        CREATE INDEX posts_message_id_idx ON posts (message_id);
+
+        CREATE TABLE post_hashtags (
+            post_id INTEGER NOT NULL,
+            hashtag_id INTEGER NOT NULL REFERENCES hashtags(id) ON DELETE CASCADE,
+            created_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (post_id, hashtag_id, created_at),
+            FOREIGN KEY (post_id, created_at) REFERENCES posts(id, created_at) ON DELETE CASCADE
+        ) PARTITION BY RANGE (created_at);
+        CREATE INDEX post_hashtags_hashtag_idx ON post_hashtags (hashtag_id, created_at);
+
+        -- creates the monthly partitions of both tables covering [from_ts, to_ts]
+        CREATE FUNCTION ensure_post_partitions(from_ts TIMESTAMP, to_ts TIMESTAMP) RETURNS void AS $$
+        DECLARE
+            m TIMESTAMP := date_trunc('month', from_ts);
+            suffix TEXT;
+        BEGIN
+            -- post_archive.PARTITION_LOCK_ID
+            PERFORM pg_advisory_xact_lock(1885434484);
+            WHILE m <= to_ts LOOP
+                suffix := to_char(m, '"p"YYYY_MM');
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF posts FOR VALUES FROM (%L) TO (%L)',
+                    'posts_' || suffix, m, m + interval '1 month');
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF post_hashtags FOR VALUES FROM (%L) TO (%L)',
+                    'post_hashtags_' || suffix, m, m + interval '1 month');
+                m := m + interval '1 month';
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql;
+
+        SELECT ensure_post_partitions(
+            LEAST(COALESCE(MIN(created_at), now()), now())::timestamp,
+            (now() + interval '2 months')::timestamp
+        ) FROM posts_old;
+
+        INSERT INTO posts(id, message_id, title, content, created_at)
+        SELECT id, message_id, title, content, COALESCE(created_at, now()) FROM posts_old;
+        INSERT INTO post_hashtags(post_id, hashtag_id, created_at)
+        SELECT ph.post_id, ph.hashtag_id, COALESCE(p.created_at, now())
+        FROM post_hashtags_old ph JOIN posts_old p ON p.id = ph.post_id;
+
+        -- hashtag_stats already counts the copied rows: triggers come after the copy
+        DROP TABLE post_hashtags_old;
+        DROP TABLE posts_old;
+        CREATE TRIGGER post_hashtags_stats_ins AFTER INSERT ON post_hashtags
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_stats_apply();
+        CREATE TRIGGER post_hashtags_stats_del AFTER DELETE ON post_hashtags
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_stats_apply();
+        """,
+    ),
+    (
+        9,
+        "unreachable users",
+        """
+        ALTER TABLE users
+            ADD COLUMN dead_reason TEXT,
+            ADD COLUMN dead_at TIMESTAMP;
+        CREATE INDEX users_dead_at_idx ON users (dead_at) WHERE dead_at IS NOT NULL;
+        """,
+    ),
+    (
+        10,
+        "bot state",
+        """
+        -- progress that must survive restarts (catchup.BotState)
+        CREATE TABLE bot_state (
+            key TEXT PRIMARY KEY,
+            value BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        """,
+    ),
+    (
+        11,
+        "related hashtags",
+        """
+        -- number of posts carrying both hashtags, stored in both directions so
+        -- the top related tags of one hashtag are a single index range scan
+        CREATE TABLE hashtag_pairs (
+            hashtag_id INTEGER NOT NULL REFERENCES hashtags(id) ON DELETE CASCADE,
+            related_id INTEGER NOT NULL REFERENCES hashtags(id) ON DELETE CASCADE,
+            posts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hashtag_id, related_id)
+        );
+        CREATE INDEX hashtag_pairs_top_idx ON hashtag_pairs (hashtag_id, posts DESC);
+        INSERT INTO hashtag_pairs(hashtag_id, related_id, posts)
+        SELECT a.hashtag_id, b.hashtag_id, COUNT(*)
+        FROM post_hashtags a
+        JOIN post_hashtags b ON b.post_id = a.post_id AND b.created_at = a.created_at
+                            AND b.hashtag_id <> a.hashtag_id
+        GROUP BY a.hashtag_id, b.hashtag_id;
+
+        -- like hashtag_stats_apply: one aggregated upsert per statement. Every
+        -- ordered pair of a post with at least one added/removed tag is
+        -- counted once. Dropped partitions are handled by post_archive.
+        CREATE FUNCTION hashtag_pairs_apply() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO hashtag_pairs AS hp (hashtag_id, related_id, posts)
+                SELECT a, b, COUNT(*) FROM (
+                    -- added tag -> every other tag of the post
+                    SELECT n.hashtag_id AS a, ph.hashtag_id AS b
+                    FROM new_rows n
+                    JOIN post_hashtags ph ON ph.post_id = n.post_id AND ph.created_at = n.created_at
+                    WHERE ph.hashtag_id <> n.hashtag_id
+                    UNION ALL
+                    -- tag the post already had -> added tag
+                    SELECT ph.hashtag_id, n.hashtag_id
+                    FROM new_rows n
+                    JOIN post_hashtags ph ON ph.post_id = n.post_id AND ph.created_at = n.created_at
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM new_rows n2
+                        WHERE n2.post_id = ph.post_id AND n2.created_at = ph.created_at
+                          AND n2.hashtag_id = ph.hashtag_id
+                    )
+                ) p
+                GROUP BY a, b
+                ON CONFLICT (hashtag_id, related_id) DO UPDATE SET posts = hp.posts + EXCLUDED.posts;
+            ELSE
+                UPDATE hashtag_pairs hp SET posts = hp.posts - d.n
+                FROM (
+                    SELECT a, b, COUNT(*) AS n FROM (
+                        -- removed tag -> other removed tags of the post
+                        SELECT o.hashtag_id AS a, o2.hashtag_id AS b
+                        FROM old_rows o
+                        JOIN old_rows o2 ON o2.post_id = o.post_id AND o2.created_at = o.created_at
+                        WHERE o2.hashtag_id <> o.hashtag_id
+                        UNION ALL
+                        -- removed tag <-> tags the post keeps
+                        SELECT o.hashtag_id, ph.hashtag_id
+                        FROM old_rows o
+                        JOIN post_hashtags ph ON ph.post_id = o.post_id AND ph.created_at = o.created_at
+                        UNION ALL
+                        SELECT ph.hashtag_id, o.hashtag_id
+                        FROM old_rows o
+                        JOIN post_hashtags ph ON ph.post_id = o.post_id AND ph.created_at = o.created_at
+                    ) p
+                    GROUP BY a, b
+                ) d
+                WHERE hp.hashtag_id = d.a AND hp.related_id = d.b;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER post_hashtags_pairs_ins AFTER INSERT ON post_hashtags
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_pairs_apply();
+        CREATE TRIGGER post_hashtags_pairs_del AFTER DELETE ON post_hashtags
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION hashtag_pairs_apply();
+        """,
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# pg_advisory_xact_lock key shared by every bot process
+SCHEMA_LOCK_ID = 0x636F6665
+
+
+async def current_version(conn: asyncpg.Connection) -> int:
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def migrate(pool: asyncpg.pool.Pool) -> int:
+    """
+    Bring the schema up to LATEST_VERSION and return the resulting version.
+
+    When nothing changed this is a single SELECT. Otherwise pending migrations
+    run in one transaction under an advisory lock, so workers starting at the
+    same time wait for the first one instead of racing on DDL.
+    """
+    async with pool.acquire() as conn:
+        version = await current_version(conn)
+        if version >= LATEST_VERSION:
+            return version
+
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT now()
+                );
+                """
+            )
+            # another worker may have migrated while we waited for the lock
+            version = await current_version(conn)
+            for number, name, sql in MIGRATIONS:
+                if number <= version:
+                    continue
+                logging.info("applying migration %s (%s)", number, name)
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_version(version, name) VALUES($1, $2)",
+                    number,
+                    name,
+                )
+                version = number
+        return version
@@ -0,0 +1,99 @@
+# post_archive.py
+import re
+import asyncio
+import logging
+import asyncpg
+from typing import List
+
+# pg_advisory_xact_lock key for partition DDL (also hard-coded in
+# migrations' ensure_post_partitions)
+PARTITION_LOCK_ID = 0x70617274
+# first key of the two-int advisory lock serializing saves of one message_id
+POST_LOCK_NS = 0x706F7374
+
+PARTITION_RE = re.compile(r"^posts_p(\d{4})_(\d{2})$")
+
+# SQL for the first instant of the "recent" window: the current month and the
+# ``$n - 1`` months before it, so it always falls on a partition boundary
+RECENT_SINCE = "date_trunc('month', now()) - make_interval(months => {} - 1)"
+
+
+async def ensure_partitions(pool: asyncpg.pool.Pool, months_ahead: int = 2) -> None:
+    """Make sure partitions exist from the current month to ``months_ahead`` months ahead."""
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            SELECT ensure_post_partitions(
+                date_trunc('month', now())::timestamp,
+                (now() + make_interval(months => $1))::timestamp
+            )
+            """,
+            months_ahead,
+        )
+
+
+async def drop_expired_partitions(pool: asyncpg.pool.Pool, keep_months: int) -> List[str]:
+    """
+    Drop monthly partitions older than the last ``keep_months`` months and
+    return their names. hashtag_stats and hashtag_pairs are adjusted first,
+    since dropping a partition does not fire the DELETE triggers that
+    maintain them.
+    """
+    dropped: List[str] = []
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", PARTITION_LOCK_ID)
+            cutoff = await conn.fetchval(
+                "SELECT date_trunc('month', now()) - make_interval(months => $1 - 1)",
+                keep_months,
+            )
+            rows = await conn.fetch(
+                """
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'posts'::regclass
+                ORDER BY c.relname
+                """
+            )
+            for r in rows:
+                m = PARTITION_RE.match(r["relname"])
+                if not m or (int(m.group(1)), int(m.group(2))) >= (cutoff.year, cutoff.month):
+                    continue
+                suffix = r["relname"][len("posts_"):]
+                await conn.execute(
+                    f"""
+                    UPDATE hashtag_stats hs SET posts = hs.posts - d.n
+                    FROM (SELECT hashtag_id, COUNT(*) AS n FROM post_hashtags_{suffix} GROUP BY hashtag_id) d
+                    WHERE hs.hashtag_id = d.hashtag_id;
+                    -- a post's tags all live in the same partition
+                    UPDATE hashtag_pairs hp SET posts = hp.posts - d.n
+                    FROM (SELECT a.hashtag_id AS a, b.hashtag_id AS b, COUNT(*) AS n
+                          FROM post_hashtags_{suffix} a
+                          JOIN post_hashtags_{suffix} b ON b.post_id = a.post_id AND b.hashtag_id <> a.hashtag_id
+                          GROUP BY 1, 2) d
+                    WHERE hp.hashtag_id = d.a AND hp.related_id = d.b;
+                    DROP TABLE post_hashtags_{suffix};
+                    -- the post_hashtags foreign key pins attached partitions
+                    ALTER TABLE posts DETACH PARTITION posts_{suffix};
+                    DROP TABLE posts_{suffix};
+                    """
+                )
+                dropped.append(r["relname"])
+    return dropped
+
+
+async def run_partition_maintenance(pool: asyncpg.pool.Pool, keep_months: int, interval: float = 86400) -> None:
+    """
+    Every ``interval`` seconds create upcoming partitions and, when
+    ``keep_months`` > 0, drop the ones past retention.
+    """
+    while True:
+        try:
+            await ensure_partitions(pool)
+            if keep_months > 0:
+                dropped = await drop_expired_partitions(pool, keep_months)
+                if dropped:
+                    logging.info("dropped post partitions: %s", ", ".join(dropped))
+        except Exception:
+            logging.exception("post partition maintenance failed")
+        await asyncio.sleep(interval)
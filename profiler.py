@@ -0,0 +1,194 @@
+# profiler.py
+import io
+import os
+import re
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+
+class Timings:
+    """count / total / max seconds per key."""
+
+    def __init__(self):
+        self.count: Counter = Counter()
+        self.total: Dict[str, float] = defaultdict(float)
+        self.max: Dict[str, float] = defaultdict(float)
+
+    def add(self, key: str, elapsed: float) -> None:
+        self.count[key] += 1
+        self.total[key] += elapsed
+        if elapsed > self.max[key]:
+            self.max[key] = elapsed
+
+    def top(self, n: int) -> List[Tuple[str, int, float, float]]:
+        keys = sorted(self.total, key=self.total.get, reverse=True)[:n]
+        return [(k, self.count[k], self.total[k], self.max[k]) for k in keys]
+
+
+class SamplingProfiler:
+    """
+    On-demand profiler for the running bot.
+
+    While a session is active a daemon thread samples the event loop thread's
+    Python stack every ``interval`` seconds (prefixed with the coroutine of
+    the asyncio task running at that moment) into collapsed-stack counts.
+    ProfilingMiddleware records handler times, ``attach`` hooks asyncpg
+    connections to record query times, and a probe task measures event loop
+    lag. Outside a session every hook is a single flag check.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.active = False
+        self._reset()
+
+    def _reset(self):
+        self.stacks: Counter = Counter()
+        self.handlers = Timings()
+        self.queries = Timings()
+        self.lag = Timings()
+        self.samples = 0
+
+    # ----- hooks -----
+    async def attach(self, conn) -> None:
+        """asyncpg pool ``init`` hook: time every query on this connection."""
+        conn.add_query_logger(self._on_query)
+
+    def _on_query(self, record) -> None:
+        if self.active:
+            self.queries.add(_normalize_query(record.query), record.elapsed)
+
+    def record_handler(self, name: str, elapsed: float) -> None:
+        if self.active:
+            self.handlers.add(name, elapsed)
+
+    # ----- sampling -----
+    def _sample_loop(self, loop: asyncio.AbstractEventLoop, thread_id: int, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            stack.reverse()
+            task = asyncio.current_task(loop)
+            root = getattr(task.get_coro(), "__qualname__", "task") if task else "<event loop>"
+            self.stacks[";".join([root] + stack)] += 1
+            self.samples += 1
+
+    async def _lag_probe(self, step: float = 0.01):
+        loop = asyncio.get_running_loop()
+        while self.active:
+            start = loop.time()
+            await asyncio.sleep(step)
+            self.lag.add("loop", max(loop.time() - start - step, 0.0))
+
+    async def run(self, seconds: float) -> "ProfileReport":
+        """Profile for ``seconds`` and return the result; one session at a time."""
+        if self.active:
+            raise RuntimeError("profiler is already running")
+        self._reset()
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample_loop, args=(loop, threading.get_ident(), stop), daemon=True
+        )
+        self.active = True
+        started = time.monotonic()
+        sampler.start()
+        probe = asyncio.create_task(self._lag_probe())
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.active = False
+            stop.set()
+            probe.cancel()
+            await loop.run_in_executor(None, sampler.join)
+        return ProfileReport(self, time.monotonic() - started)
+
+
+class ProfileReport:
+    def __init__(self, profiler: SamplingProfiler, duration: float):
+        self.duration = duration
+        self.samples = profiler.samples
+        self.stacks = profiler.stacks
+        self.handlers = profiler.handlers
+        self.queries = profiler.queries
+        self.lag = profiler.lag
+
+    def collapsed(self) -> bytes:
+        """Brendan Gregg's folded format, ready for flamegraph.pl / speedscope."""
+        lines = [f"{stack} {n}" for stack, n in self.stacks.most_common()]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def collapsed_file(self) -> types.InputFile:
+        return types.InputFile(io.BytesIO(self.collapsed()), filename="profile.folded")
+
+    def summary(self, top: int = 10) -> str:
+        out = [f"⏱ پروفایل {self.duration:.0f} ثانیه — {self.samples} نمونه"]
+        if self.lag.count["loop"]:
+            avg = self.lag.total["loop"] / self.lag.count["loop"]
+            out.append(f"event loop lag: avg {avg * 1000:.1f}ms, max {self.lag.max['loop'] * 1000:.1f}ms")
+        out.append("\nکندترین هندلرها (total / count / max):")
+        for name, count, total, worst in self.handlers.top(top):
+            out.append(f"{name}: {total * 1000:.0f}ms / {count} / {worst * 1000:.0f}ms")
+        out.append("\nکندترین کوئری‌ها (total / count / max):")
+        for query, count, total, worst in self.queries.top(top):
+            out.append(f"{query}: {total * 1000:.0f}ms / {count} / {worst * 1000:.0f}ms")
+        return "\n".join(out)[:4000]
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Times each handler while the profiler is active."""
+
+    def __init__(self, profiler: SamplingProfiler):
+        super().__init__()
+        self.profiler = profiler
+
+    def _start(self, data: dict):
+        if self.profiler.active:
+            handler = current_handler.get(None)
+            data["_profile"] = (getattr(handler, "__name__", "?"), time.perf_counter())
+
+    def _stop(self, data: dict):
+        started = data.get("_profile")
+        if started:
+            self.profiler.record_handler(started[0], time.perf_counter() - started[1])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._stop(data)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results, data: dict):
+        self._stop(data)
+
+    async def on_process_channel_post(self, message: types.Message, data: dict):
+        self._start(data)
+
+    async def on_post_process_channel_post(self, message: types.Message, results, data: dict):
+        self._stop(data)
+
+    async def on_process_inline_query(self, query: types.InlineQuery, data: dict):
+        self._start(data)
+
+    async def on_post_process_inline_query(self, query: types.InlineQuery, results, data: dict):
+        self._stop(data)
+
+
+def _normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip()[:120]
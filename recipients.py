@@ -0,0 +1,138 @@
+# recipients.py
+import asyncio
+import logging
+import asyncpg
+from typing import Dict, Set
+from aiogram.utils.exceptions import (
+    BotBlocked,
+    BotKicked,
+    CantInitiateConversation,
+    CantTalkWithBots,
+    ChatNotFound,
+    NetworkError,
+    RetryAfter,
+    UserDeactivated,
+)
+
+# delivery failure classes
+BLOCKED = "blocked"
+DEACTIVATED = "deactivated"
+CHAT_NOT_FOUND = "chat_not_found"
+TRANSIENT = "transient"
+OTHER = "other"
+
+# failures that will not go away by retrying later
+DEAD = (BLOCKED, DEACTIVATED, CHAT_NOT_FOUND)
+
+
+def classify_error(error: BaseException) -> str:
+    if isinstance(error, (BotBlocked, BotKicked)):
+        return BLOCKED
+    if isinstance(error, UserDeactivated):
+        return DEACTIVATED
+    if isinstance(error, (ChatNotFound, CantInitiateConversation, CantTalkWithBots)):
+        return CHAT_NOT_FOUND
+    if isinstance(error, (RetryAfter, NetworkError, asyncio.TimeoutError)):
+        return TRANSIENT
+    return OTHER
+
+
+class DeadRecipients:
+    """
+    Collects permanently unreachable users during a fan-out and marks them
+    in ``users`` in one statement per ``flush``. Marked users are skipped by
+    every fan-out query (``users.dead_at IS NULL``); deleted accounts also
+    lose their subscriptions right away, the others only after
+    ``prune_dead_subscriptions`` (they may unblock the bot and come back).
+
+    The ids of marked users are mirrored in memory (``load`` at startup,
+    then ``flush``/``revive``), so ``revive`` only writes for users that
+    actually are marked. Share one instance per process for that to hold.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+        self._pending: Dict[int, str] = {}
+        self._dead: Set[int] = set()
+        self.counters: Dict[str, int] = {}
+
+    async def load(self) -> int:
+        """Read the ids of users marked as unreachable."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT user_id FROM users WHERE dead_at IS NOT NULL")
+        self._dead = {r["user_id"] for r in rows}
+        return len(self._dead)
+
+    def add(self, user_id: int, reason: str) -> None:
+        self._pending[user_id] = reason
+        self.counters[reason] = self.counters.get(reason, 0) + 1
+
+    def record(self, user_id: int, error: BaseException) -> str:
+        """Classify ``error``; dead recipients are queued for the next flush."""
+        reason = classify_error(error)
+        if reason in DEAD:
+            self.add(user_id, reason)
+        return reason
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        gone = [uid for uid, reason in pending.items() if reason == DEACTIVATED]
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(
+                    """
+                    UPDATE users u SET dead_reason = d.reason, dead_at = NOW()
+                    FROM unnest($1::bigint[], $2::text[]) AS d(user_id, reason)
+                    WHERE u.user_id = d.user_id AND u.dead_at IS NULL
+                    RETURNING u.user_id
+                    """,
+                    list(pending),
+                    list(pending.values()),
+                )
+                if gone:
+                    await conn.execute("DELETE FROM subscriptions WHERE user_id = ANY($1::bigint[])", gone)
+        self._dead.update(r["user_id"] for r in rows)
+        marked = len(rows)
+        if marked:
+            logging.info("marked %s unreachable users", marked)
+        return marked
+
+    async def revive(self, user_id: int) -> bool:
+        """Clear the mark of a user that is reachable again (e.g. unblocked the bot)."""
+        self._pending.pop(user_id, None)
+        if user_id not in self._dead:
+            return False
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                "UPDATE users SET dead_reason = NULL, dead_at = NULL WHERE user_id = $1 AND dead_at IS NOT NULL",
+                user_id,
+            )
+        self._dead.discard(user_id)
+        return status != "UPDATE 0"
+
+
+async def prune_dead_subscriptions(pool: asyncpg.pool.Pool, after_days: int) -> int:
+    """Delete subscriptions of users unreachable for more than ``after_days`` days."""
+    async with pool.acquire() as conn:
+        status = await conn.execute(
+            """
+            DELETE FROM subscriptions s USING users u
+            WHERE u.user_id = s.user_id
+              AND u.dead_at < NOW() - make_interval(days => $1)
+            """,
+            after_days,
+        )
+    return int(status.split()[-1])
+
+
+async def run_dead_pruning(pool: asyncpg.pool.Pool, after_days: int, interval: float = 86400) -> None:
+    while True:
+        try:
+            pruned = await prune_dead_subscriptions(pool, after_days)
+            if pruned:
+                logging.info("pruned %s subscriptions of unreachable users", pruned)
+        except Exception:
+            logging.exception("pruning dead subscriptions failed")
+        await asyncio.sleep(interval)
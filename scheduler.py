@@ -0,0 +1,228 @@
+# scheduler.py
+import asyncio
+import logging
+import contextlib
+import aiohttp
+from contextvars import ContextVar
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from aiohttp.helpers import sentinel
+from aiogram import Bot, Dispatcher, types
+
+
+class _Slot:
+    """One of the dispatcher's ``max_concurrency`` slots, held by an update."""
+    __slots__ = ("slots", "held")
+
+    def __init__(self, slots: asyncio.Semaphore):
+        self.slots = slots
+        self.held = True
+
+
+# slot of the update being processed in this context
+_current_slot: ContextVar[Optional[_Slot]] = ContextVar("scheduler_slot", default=None)
+
+
+@contextlib.asynccontextmanager
+async def slot_released():
+    """
+    Give the current update's processing slot back while waiting inside a
+    handler or middleware (e.g. a throttling delay), so waiting updates
+    don't keep other chats from being processed. The chat's later updates
+    still wait. Outside OrderedDispatcher this does nothing.
+    """
+    slot = _current_slot.get()
+    if slot is None or not slot.held:
+        yield
+        return
+    slot.held = False
+    slot.slots.release()
+    try:
+        yield
+    finally:
+        await slot.slots.acquire()
+        slot.held = True
+
+
+def chat_key(update: types.Update) -> Optional[int]:
+    """Chat whose updates must be processed in order; None = no ordering needed."""
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message:
+        return message.chat.id
+    if update.callback_query:
+        call = update.callback_query
+        return call.message.chat.id if call.message else call.from_user.id
+    member = update.my_chat_member or update.chat_member or update.chat_join_request
+    if member:
+        return member.chat.id
+    # inline queries and the like touch no per-chat state
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """
+    Dispatcher that processes updates of different chats concurrently but
+    the updates of one chat strictly one after another, so handlers of the
+    same conversation never race on FSM state.
+
+    - at most ``max_concurrency`` updates are processed at once;
+    - each chat queues at most ``max_queue_per_chat`` waiting updates,
+      further ones from that chat are dropped (and counted);
+    - with ``max_pending`` updates queued in total, polling waits until
+      there is room again instead of fetching more. Batches are enqueued
+      one after another, so a chat's updates keep their order while they
+      wait.
+    """
+
+    def __init__(self, bot, *args, max_concurrency: int = 64, max_queue_per_chat: int = 32,
+                 max_pending: int = 10000, **kwargs):
+        super().__init__(bot, *args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_chat = max_queue_per_chat
+        self.max_pending = max_pending
+        self._queues: Dict[int, Deque[Tuple[types.Update, asyncio.Future]]] = {}
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._room = asyncio.Event()
+        self._room.set()
+        # batches enqueue in arrival order (asyncio.Lock wakes waiters FIFO)
+        self._feed = asyncio.Lock()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._pending = 0
+        # highest update_id processed so far (catchup checkpoints it)
+        self.last_update_id = 0
+        self.counters: Counter = Counter()
+
+    async def process_updates(self, updates, fast: bool = True):
+        async with self._feed:
+            for update in updates:
+                await self._room.wait()
+                self.enqueue(update)
+        # handlers run in the background; webhook-style responses are not used
+        return []
+
+    async def start_polling(self, timeout: int = 20, relax: float = 0.1, limit: Optional[int] = None,
+                            reset_webhook: Optional[bool] = None, fast: bool = True, error_sleep: int = 5,
+                            allowed_updates: Optional[List[str]] = None):
+        """
+        Dispatcher.start_polling, except that a batch is enqueued before the
+        next getUpdates call: aiogram hands batches to unawaited tasks, so
+        polling would keep fetching while the queues are full.
+        """
+        if self._polling:
+            raise RuntimeError("Polling already started")
+        logging.info("Start polling.")
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        offset = None
+        try:
+            current_request_timeout = self.bot.timeout
+            if current_request_timeout is not sentinel and timeout is not None:
+                request_timeout = aiohttp.ClientTimeout(total=current_request_timeout.total + timeout or 1)
+            else:
+                request_timeout = None
+            while self._polling:
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(
+                            limit=limit, offset=offset, timeout=timeout, allowed_updates=allowed_updates
+                        )
+                except asyncio.CancelledError:
+                    break
+                except Exception:
+                    logging.exception("Cause exception while getting updates.")
+                    await asyncio.sleep(error_sleep)
+                    continue
+                if updates:
+                    offset = updates[-1].update_id + 1
+                    await self.process_updates(updates, fast)
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            logging.warning("Polling is stopped.")
+
+    def enqueue(self, update: types.Update) -> asyncio.Future:
+        """Schedule ``update``; the returned future resolves when it was processed."""
+        future = asyncio.get_running_loop().create_future()
+        key = chat_key(update)
+        if key is None:
+            self._add_pending()
+            asyncio.create_task(self._process(update, future))
+            return future
+
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            asyncio.create_task(self._drain_chat(key, queue))
+        elif len(queue) >= self.max_queue_per_chat:
+            self.counters["dropped"] += 1
+            logging.warning("update queue of chat %s is full, dropping update %s", key, update.update_id)
+            future.set_result(None)
+            return future
+        queue.append((update, future))
+        self._add_pending()
+        self.counters["peak_chats"] = max(self.counters["peak_chats"], len(self._queues))
+        return future
+
+    def _add_pending(self) -> None:
+        self._pending += 1
+        self._idle.clear()
+        if self._pending >= self.max_pending:
+            self._room.clear()
+        self.counters["peak_pending"] = max(self.counters["peak_pending"], self._pending)
+
+    async def _drain_chat(self, key: int, queue: Deque[Tuple[types.Update, asyncio.Future]]) -> None:
+        try:
+            while queue:
+                update, future = queue.popleft()
+                await self._process(update, future)
+        finally:
+            del self._queues[key]
+
+    async def _process(self, update: types.Update, future: asyncio.Future) -> None:
+        await self._slots.acquire()
+        slot = _Slot(self._slots)
+        token = _current_slot.set(slot)
+        try:
+            try:
+                # own task = own context: aiogram caches per-update state in ContextVars
+                result = await asyncio.create_task(self.updates_handler.notify(update))
+            except Exception as e:
+                self.counters["errors"] += 1
+                logging.exception("update %s failed", update.update_id)
+                future.set_exception(e)
+                # the caller may not be waiting; don't warn about it
+                future.exception()
+            else:
+                future.set_result(result)
+            finally:
+                self.counters["processed"] += 1
+                self.last_update_id = max(self.last_update_id, update.update_id)
+                self._pending -= 1
+                if self._pending < self.max_pending:
+                    self._room.set()
+                if not self._pending:
+                    self._idle.set()
+        finally:
+            _current_slot.reset(token)
+            # not held if cancelled while taking it back in slot_released
+            if slot.held:
+                self._slots.release()
+
+    async def drain(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds for queued updates; True if all finished."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def scheduler_stats(self) -> Dict[str, int]:
+        return {"pending": self._pending, "chats": len(self._queues), **self.counters}
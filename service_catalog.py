@@ -0,0 +1,140 @@
+# service_catalog.py
+import asyncio
+import logging
+import asyncpg
+from typing import Dict, List, NamedTuple, Optional
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+
+class Category(NamedTuple):
+    id: int
+    name: str
+
+
+class Service(NamedTuple):
+    id: int
+    category_id: int
+    title: str
+    documents: Optional[str]
+    price: Optional[int]
+
+
+class ServiceCatalog:
+    """
+    In-memory copy of service_categories/services with prerendered keyboards.
+
+    Callback data carries numeric ids only (``service_cat:<id>``,
+    ``service_item:<id>``), which keeps it far below Telegram's 64 byte limit.
+    Every change to the tables bumps ``catalog_version`` (by trigger), so a
+    worker reloads after its own admin edits and notices other workers'
+    edits by polling that single row.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+        self.version = -1
+        self.categories: List[Category] = []
+        self.category_by_id: Dict[int, Category] = {}
+        self.category_by_name: Dict[str, Category] = {}
+        self.services: Dict[int, Service] = {}
+        self.services_by_category: Dict[int, List[Service]] = {}
+        self._menu_kb = InlineKeyboardMarkup()
+        self._category_kb: Dict[int, InlineKeyboardMarkup] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+
+    async def seed(self, services: Dict[str, List[str]]) -> None:
+        """Insert a {category: [service titles]} dict if the catalog is empty."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM service_categories)"):
+                    return
+                for category, titles in services.items():
+                    cat_id = await conn.fetchval(
+                        "INSERT INTO service_categories(name) VALUES($1) RETURNING id", category
+                    )
+                    await conn.executemany(
+                        "INSERT INTO services(category_id, title) VALUES($1, $2) ON CONFLICT DO NOTHING",
+                        [(cat_id, t) for t in titles],
+                    )
+
+    async def load(self) -> None:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                version = await conn.fetchval("SELECT version FROM catalog_version")
+                cats = await conn.fetch("SELECT id, name FROM service_categories ORDER BY id")
+                items = await conn.fetch(
+                    "SELECT id, category_id, title, documents, price FROM services ORDER BY id"
+                )
+
+        categories = [Category(r["id"], r["name"]) for r in cats]
+        services = {r["id"]: Service(*r.values()) for r in items}
+        by_category: Dict[int, List[Service]] = {c.id: [] for c in categories}
+        for s in services.values():
+            by_category.setdefault(s.category_id, []).append(s)
+
+        menu_kb = InlineKeyboardMarkup(row_width=2)
+        for c in categories:
+            menu_kb.add(InlineKeyboardButton(c.name, callback_data=f"service_cat:{c.id}"))
+        category_kb = {}
+        for c in categories:
+            kb = InlineKeyboardMarkup(row_width=2)
+            for s in by_category[c.id]:
+                kb.add(InlineKeyboardButton(s.title, callback_data=f"service_item:{s.id}"))
+            kb.add(InlineKeyboardButton("⬅️ بازگشت", callback_data="back_to_services"))
+            category_kb[c.id] = kb
+
+        # swap everything at once so handlers never see a half-built catalog
+        self.categories = categories
+        self.category_by_id = {c.id: c for c in categories}
+        self.category_by_name = {c.name: c for c in categories}
+        self.services = services
+        self.services_by_category = by_category
+        self._menu_kb = menu_kb
+        self._category_kb = category_kb
+        self.version = version
+        logging.info("service catalog v%s loaded: %s categories, %s services",
+                     version, len(categories), len(services))
+
+    async def refresh(self) -> bool:
+        """Reload if the stored version moved; returns True when reloaded."""
+        async with self.pool.acquire() as conn:
+            version = await conn.fetchval("SELECT version FROM catalog_version")
+        if version == self.version:
+            return False
+        await self.load()
+        return True
+
+    def start_polling(self, interval: float) -> None:
+        async def _loop():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.refresh()
+                except Exception:
+                    logging.exception("service catalog refresh failed")
+
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.create_task(_loop())
+
+    def menu_keyboard(self) -> InlineKeyboardMarkup:
+        return self._menu_kb
+
+    def category_keyboard(self, category_id: int) -> Optional[InlineKeyboardMarkup]:
+        return self._category_kb.get(category_id)
+
+    async def add_service(self, category_id: int, title: str, documents: Optional[str],
+                          price: Optional[int]) -> Optional[int]:
+        """Returns the new service's id, or None if the category already has that title."""
+        async with self.pool.acquire() as conn:
+            service_id = await conn.fetchval(
+                """
+                INSERT INTO services(category_id, title, documents, price)
+                VALUES($1, $2, $3, $4)
+                ON CONFLICT (category_id, title) DO NOTHING
+                RETURNING id
+                """,
+                category_id, title, documents, price,
+            )
+        if service_id is not None:
+            await self.load()
+        return service_id
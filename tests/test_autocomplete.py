@@ -0,0 +1,87 @@
+from autocomplete import TermIndex, normalize, title_words
+
+
+def completions(index: TermIndex, prefix: str):
+    return [index.terms[tid] for tid in index.complete(prefix)]
+
+
+def test_normalize_unifies_spelling_variants():
+    assert normalize("علي") == normalize("علی")
+    assert normalize("كتاب") == normalize("کتاب")
+    assert normalize("می‌شود") == normalize("میشود")
+    assert normalize("آزمون") == normalize("ازمون")
+    assert normalize("کنکور۱۴۰۳") == "کنکور1403"
+    assert normalize("#Konkur_Test") == "konkur test"
+
+
+def test_title_words_skip_stop_words_and_numbers():
+    assert title_words("ثبت نام کنکور در سال ۱۴۰۳") == ["ثبت", "نام", "کنکور", "سال"]
+
+
+def test_complete_orders_by_weight():
+    index = TermIndex(k=3)
+    index.add("کتاب", 2)
+    index.add("کنکور", 5)
+    index.add("کار", 1)
+    index.add("کلاس", 3)
+    assert completions(index, "ک") == ["کنکور", "کلاس", "کتاب"]
+    assert completions(index, "کن") == ["کنکور"]
+    index.add("کار", 10)
+    assert completions(index, "ک") == ["کار", "کنکور", "کلاس"]
+
+
+def test_complete_matches_spelling_variants():
+    index = TermIndex()
+    index.add("كتاب")
+    index.add("علي")
+    index.add("می‌شود")
+    assert completions(index, "کت") == ["كتاب"]
+    assert completions(index, "علی") == ["علي"]
+    assert completions(index, "میش") == ["می‌شود"]
+
+
+def test_hashtag_and_word_are_separate_terms():
+    index = TermIndex()
+    index.add("#کنکور", 3)
+    index.add("کنکور", 1)
+    assert completions(index, "کنک") == ["#کنکور", "کنکور"]
+
+
+def test_remove_moves_term_down_and_drops_it_at_zero():
+    index = TermIndex(k=3)
+    index.add("کنکور", 3)
+    index.add("کلاس", 2)
+    index.remove("کنکور", 2)
+    assert completions(index, "ک") == ["کلاس", "کنکور"]
+    index.remove("کنکور")
+    assert completions(index, "ک") == ["کلاس"]
+    assert completions(index, "کن") == []
+    index.add("کنکور")
+    assert completions(index, "کن") == ["کنکور"]
+
+
+def test_remove_unknown_term_is_ignored():
+    index = TermIndex()
+    index.remove("کنکور")
+    assert completions(index, "ک") == []
+
+
+def test_update_post_only_reweights_changes():
+    index = TermIndex()
+    index.add_post("کتاب ریاضی", ["#کنکور"])
+    for _ in range(3):
+        index.update_post("کتاب ریاضی", ["#کنکور"], "کتاب ریاضی", ["#کنکور"])
+    weights = {index.terms[tid]: index._weights[tid] for tid in range(len(index))}
+    assert weights == {"#کنکور": 1, "کتاب": 1, "ریاضی": 1}
+
+    index.update_post("کتاب ریاضی", ["#کنکور"], "جزوه ریاضی", ["#جزوه"])
+    assert completions(index, "ک") == []
+    assert set(completions(index, "ج")) == {"جزوه", "#جزوه"}
+    assert completions(index, "ری") == ["ریاضی"]
+
+
+def test_update_post_of_deleted_post_removes_its_terms():
+    index = TermIndex()
+    index.add_post("کتاب ریاضی", ["#کنکور"])
+    index.update_post("کتاب ریاضی", ["#کنکور"], "", [])
+    assert completions(index, "") == []
@@ -0,0 +1,128 @@
+import asyncio
+
+from aiogram import Bot, types
+
+from scheduler import OrderedDispatcher, slot_released
+from throttling import DEFAULT_KEY, ThrottlingMiddleware
+
+TOKEN = "123456:TESTTESTTESTTESTTESTTESTTESTTESTTEST"
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> types.Update:
+    return types.Update.to_object({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "t"},
+            "text": text,
+        },
+    })
+
+
+def make_dispatcher(**kwargs):
+    return OrderedDispatcher(Bot(TOKEN), **kwargs)
+
+
+def test_chat_order_kept_when_pending_is_full():
+    async def run():
+        dp = make_dispatcher(max_pending=2, max_concurrency=4)
+        seen = []
+
+        async def handler(message: types.Message):
+            await asyncio.sleep(0.001)
+            seen.append(int(message.text))
+
+        dp.register_message_handler(handler)
+        batches = [
+            [message_update(i, 1, str(i)) for i in range(1, 6)],
+            [message_update(i, 1, str(i)) for i in range(6, 11)],
+        ]
+        # aiogram's polling hands every batch to its own unawaited task
+        await asyncio.gather(*(dp.process_updates(b) for b in batches))
+        assert await dp.drain(5)
+        return seen
+
+    assert asyncio.run(run()) == list(range(1, 11))
+
+
+def test_polling_waits_for_room_before_fetching():
+    async def run():
+        dp = make_dispatcher(max_pending=2)
+        release = asyncio.Event()
+        fetched = []
+
+        async def handler(message: types.Message):
+            await release.wait()
+
+        async def get_updates(offset=None, **kwargs):
+            fetched.append(offset)
+            if len(fetched) == 3:
+                dp.stop_polling()
+            first = offset or 1
+            return [message_update(i, i, "x") for i in range(first, first + 3)]
+
+        async def delete_webhook(**kwargs):
+            return True
+
+        dp.register_message_handler(handler)
+        dp.bot.get_updates = get_updates
+        dp.bot.delete_webhook = delete_webhook
+        polling = asyncio.create_task(dp.start_polling(relax=0))
+        await asyncio.sleep(0.05)
+        # the first batch doesn't fit: no second getUpdates yet
+        stalled = list(fetched)
+        release.set()
+        await polling
+        assert await dp.drain(5)
+        return stalled, fetched, dp.scheduler_stats()
+
+    stalled, fetched, stats = asyncio.run(run())
+    assert stalled == [None]
+    assert fetched == [None, 4, 7]
+    assert stats["processed"] == 9
+    assert stats["peak_pending"] == 2
+
+
+def test_released_slot_lets_other_chats_run():
+    async def run():
+        dp = make_dispatcher(max_concurrency=1)
+        order = []
+
+        async def handler(message: types.Message):
+            if message.text == "slow":
+                async with slot_released():
+                    await asyncio.sleep(0.05)
+            order.append(message.text)
+
+        dp.register_message_handler(handler)
+        await dp.process_updates([message_update(1, 1, "slow"), message_update(2, 2, "fast")])
+        assert await dp.drain(5)
+        return order, dp._slots._value
+
+    order, free = asyncio.run(run())
+    assert order == ["fast", "slow"]
+    assert free == 1
+
+
+def test_deferred_update_does_not_hold_a_slot():
+    async def run():
+        dp = make_dispatcher(max_concurrency=1)
+        dp.middleware.setup(ThrottlingMiddleware({DEFAULT_KEY: (10, 1)}, max_delay=1))
+        order = []
+
+        async def handler(message: types.Message):
+            order.append(message.text)
+
+        dp.register_message_handler(handler)
+        await dp.process_updates([message_update(1, 1, "a1")])
+        assert await dp.drain(5)
+        await dp.process_updates([
+            message_update(2, 1, "a2"),  # bucket empty: deferred for ~0.1s
+            message_update(3, 2, "b1"),
+        ])
+        assert await dp.drain(5)
+        return order
+
+    assert asyncio.run(run()) == ["a1", "b1", "a2"]
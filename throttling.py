@@ -0,0 +1,136 @@
+# throttling.py
+import time
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, Optional, Tuple
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from scheduler import slot_released
+
+DEFAULT_KEY = "default"
+
+
+def rate_limit(key: str):
+    """Put a handler into throttling class ``key`` (see ThrottlingMiddleware)."""
+    def decorator(func):
+        setattr(func, "throttling_key", key)
+        return func
+    return decorator
+
+
+def parse_limit(value: str, default: Tuple[float, float]) -> Tuple[float, float]:
+    """Parse "rate,burst" (tokens per second, bucket size) from an env var."""
+    try:
+        rate, burst = (float(x) for x in value.split(","))
+        return rate, burst
+    except ValueError:
+        return default
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.warned = False
+
+    def refill(self, rate: float, burst: float, now: float) -> None:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    In-memory token buckets per (user, handler class).
+
+    A handler's class is the key given with ``rate_limit``; undecorated
+    handlers share DEFAULT_KEY. When a bucket is empty the update is deferred
+    if a token frees up within ``max_delay`` seconds, otherwise it is dropped
+    before the handler (and its DB queries) runs. Callback queries that are
+    dropped get a single "slow down" answer per burst.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], max_delay: float = 1.0,
+                 max_buckets: int = 100_000):
+        super().__init__()
+        self.limits = limits
+        self.max_delay = max_delay
+        self.max_buckets = max_buckets
+        self.buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self.counters: Counter = Counter()
+
+    def _limit(self, key: str) -> Tuple[float, float]:
+        return self.limits.get(key) or self.limits[DEFAULT_KEY]
+
+    def _prune(self, now: float) -> None:
+        """Forget buckets that are full again; they carry no state."""
+        for k, b in list(self.buckets.items()):
+            rate, burst = self._limit(k[1])
+            if b.tokens + (now - b.updated) * rate >= burst:
+                del self.buckets[k]
+
+    async def _throttle(self, user_id: int, key: str) -> Optional[TokenBucket]:
+        """Take a token; returns the bucket if the update has to be dropped."""
+        rate, burst = self._limit(key)
+        now = time.monotonic()
+        bucket = self.buckets.get((user_id, key))
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = self.buckets[(user_id, key)] = TokenBucket(burst, now)
+        else:
+            bucket.refill(rate, burst, now)
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return None
+
+        delay = (1 - bucket.tokens) / rate
+        if delay <= self.max_delay:
+            # reserve the token now so concurrent updates queue up behind it
+            bucket.tokens -= 1
+            self.counters[(key, "deferred")] += 1
+            # don't hold one of the dispatcher's processing slots while waiting
+            async with slot_released():
+                await asyncio.sleep(delay)
+            return None
+
+        self.counters[(key, "dropped")] += 1
+        return bucket
+
+    @staticmethod
+    def _key() -> str:
+        handler = current_handler.get(None)
+        return getattr(handler, "throttling_key", DEFAULT_KEY)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if not message.from_user:
+            return
+        key = self._key()
+        if await self._throttle(message.from_user.id, key):
+            logging.debug("throttled message from %s (%s)", message.from_user.id, key)
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        key = self._key()
+        bucket = await self._throttle(call.from_user.id, key)
+        if bucket:
+            if not bucket.warned:
+                bucket.warned = True
+                await call.answer("⏳ لطفاً کمی صبر کنید...")
+            raise CancelHandler()
+
+    async def on_process_inline_query(self, query: types.InlineQuery, data: dict):
+        # a dropped inline query needs no answer: the client keeps its last results
+        if await self._throttle(query.from_user.id, self._key()):
+            raise CancelHandler()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        out: Dict[str, Dict[str, int]] = {}
+        for (key, kind), n in self.counters.items():
+            out.setdefault(key, {})[kind] = n
+        return out